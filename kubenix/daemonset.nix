@@ -96,6 +96,10 @@ in
                       name = "BUILD_CACHE";
                       value = lib.boolToString cfg.cache.enable;
                     }
+                    {
+                      name = "NIX_CSI_PREFETCH";
+                      value = lib.boolToString cfg.prefetch.enable;
+                    }
                   ];
                   volumeMounts = [
                     {
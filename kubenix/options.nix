@@ -24,6 +24,7 @@
         in
         image;
     };
+    prefetch.enable = lib.mkEnableOption "building volumes of Pods scheduled to a node before kubelet asks for them";
     hostMountPath = lib.mkOption {
       description = "Where on the host to put cknix store";
       type = lib.types.path;
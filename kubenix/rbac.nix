@@ -67,5 +67,37 @@ in
         };
       };
     };
+
+    # Prefetching watches Pods bound to the node in every namespace
+    kubernetes.resources.none = lib.mkIf cfg.prefetch.enable {
+      ClusterRole.nix-csi-prefetch = {
+        rules = [
+          {
+            apiGroups = [ "" ];
+            resources = [ "pods" ];
+            verbs = [
+              "get"
+              "list"
+              "watch"
+            ];
+          }
+        ];
+      };
+
+      ClusterRoleBinding.nix-csi-prefetch = {
+        subjects = [
+          {
+            kind = "ServiceAccount";
+            name = "nix-csi";
+            namespace = cfg.namespace;
+          }
+        ];
+        roleRef = {
+          kind = "ClusterRole";
+          name = "nix-csi-prefetch";
+          apiGroup = "rbac.authorization.k8s.io";
+        };
+      };
+    };
   };
 }
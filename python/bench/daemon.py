@@ -0,0 +1,184 @@
+import asyncio
+import sqlite3
+import struct
+import threading
+
+from pathlib import Path
+from typing import List, Optional
+
+from nix_csi.daemon import (
+    OP_ADD_INDIRECT_ROOT,
+    OP_ADD_TEMP_ROOT,
+    OP_BUILD_PATHS,
+    OP_IS_VALID_PATH,
+    OP_QUERY_PATH_INFO,
+    STDERR_ERROR,
+    STDERR_LAST,
+    WORKER_MAGIC_1,
+    WORKER_MAGIC_2,
+    encode_int,
+    encode_string,
+    encode_strings,
+    minor,
+)
+
+VERSION = (1 << 8) | 35
+
+
+class FakeDaemon:
+    """
+    Speaks enough of the nix-daemon worker protocol for nix-csi, answering
+    from the synthetic store's database. Runs its own event loop on a
+    thread like the real daemon would run in its own process. Every
+    operation sleeps latency seconds first. version is the protocol
+    version offered, down to 1.21 like the client.
+    """
+
+    def __init__(
+        self, socketPath: Path, dbPath: Path, latency: float = 0, version: int = VERSION
+    ):
+        self.socketPath = socketPath
+        self.dbPath = dbPath
+        self.latency = latency
+        self.version = version
+        self.ops = 0
+        self.connections = 0
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def shutdown(self):
+        self.server.close()
+        handlers = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def serve(self):
+        asyncio.set_event_loop(self.loop)
+        self.db = sqlite3.connect(self.dbPath)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_unix_server(self.handle, path=str(self.socketPath))
+        )
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.close()
+        self.db.close()
+
+    def path_id(self, path: str) -> Optional[int]:
+        row = self.db.execute("SELECT id FROM ValidPaths WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def path_info(self, path: str) -> bytes:
+        row = self.db.execute(
+            "SELECT id, hash, registrationTime, narSize, deriver FROM ValidPaths"
+            " WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if row is None:
+            return encode_int(0)
+        id, narHash, registrationTime, narSize, deriver = row
+        references = [
+            reference
+            for (reference,) in self.db.execute(
+                "SELECT v.path FROM Refs r JOIN ValidPaths v ON v.id = r.reference"
+                " WHERE r.referrer = ?",
+                (id,),
+            )
+        ]
+        return b"".join(
+            [
+                encode_int(1),
+                encode_string(deriver or ""),
+                encode_string(narHash.removeprefix("sha256:")),
+                encode_strings(references),
+                encode_int(registrationTime),
+                encode_int(narSize or 0),
+                encode_int(0),
+                encode_strings([]),
+                encode_string(""),
+            ]
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+
+        async def read_int() -> int:
+            return struct.unpack("<Q", await reader.readexactly(8))[0]
+
+        async def read_string() -> str:
+            length = await read_int()
+            return (await reader.readexactly(length + (-length % 8)))[:length].decode()
+
+        async def read_strings() -> List[str]:
+            return [await read_string() for _ in range(await read_int())]
+
+        def error(message: str) -> bytes:
+            if minor(self.version) < 26:
+                return encode_int(STDERR_ERROR) + encode_string(message) + encode_int(1)
+            return b"".join(
+                [
+                    encode_int(STDERR_ERROR),
+                    encode_string("Error"),
+                    encode_int(0),
+                    encode_string("Error"),
+                    encode_string(message),
+                    encode_int(0),
+                    encode_int(0),
+                ]
+            )
+
+        try:
+            if await read_int() != WORKER_MAGIC_1:
+                return
+            writer.write(encode_int(WORKER_MAGIC_2) + encode_int(self.version))
+            await read_int()  # client version
+            await read_int()  # CPU affinity
+            await read_int()  # reserveSpace
+            if minor(self.version) >= 33:
+                writer.write(encode_string("bench"))
+            if minor(self.version) >= 35:
+                writer.write(encode_int(1))
+            writer.write(encode_int(STDERR_LAST))
+            while True:
+                op = await read_int()
+                self.ops += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                last = encode_int(STDERR_LAST)
+                if op == OP_IS_VALID_PATH:
+                    valid = self.path_id(await read_string()) is not None
+                    writer.write(last + encode_int(valid))
+                elif op in (OP_ADD_TEMP_ROOT, OP_ADD_INDIRECT_ROOT):
+                    await read_string()
+                    writer.write(last + encode_int(1))
+                elif op == OP_QUERY_PATH_INFO:
+                    writer.write(last + self.path_info(await read_string()))
+                elif op == OP_BUILD_PATHS:
+                    paths = await read_strings()
+                    await read_int()  # build mode
+                    missing = [p for p in paths if self.path_id(p) is None]
+                    if missing:
+                        # Nothing to substitute from
+                        writer.write(error(f"path '{missing[0]}' is not valid"))
+                    else:
+                        writer.write(last + encode_int(1))
+                else:
+                    # Can't skip arguments we don't know the shape of
+                    writer.write(error(f"invalid operation {op}"))
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Clients hanging up, or stop()
+            pass
+        finally:
+            writer.close()
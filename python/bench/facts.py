@@ -0,0 +1,113 @@
+"""
+Time resolving node facts at startup and looking them up on the publish
+path, against a Nix config directory of --entries files. Run from the
+python directory:
+
+    python -m bench.facts --entries 10 1000 --gets 10000
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from pathlib import Path
+from typing import List
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi node facts benchmark")
+    parser.add_argument("--entries", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--gets", type=int, default=10000, help="lookups per round")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--nix-latency", type=float, default=0.05)
+    return parser.parse_args()
+
+
+async def lag(stop: asyncio.Event, samples: List[float]):
+    """How late the loop runs a task that wants to run every millisecond"""
+    while not stop.is_set():
+        start_time = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append(time.perf_counter() - start_time - 0.001)
+
+
+def resolves(nixLog: Path) -> int:
+    return nixLog.read_text().count("config show")
+
+
+async def measure(confDir: Path, nixLog: Path, args) -> dict:
+    from nix_csi import facts
+
+    cache = facts.NodeFactsCache(confDir, checkInterval=0.1)
+    start_time = time.perf_counter()
+    await cache.refresh()
+    startup = time.perf_counter() - start_time
+
+    latencies: List[float] = []
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def get():
+        async with limit:
+            start_time = time.perf_counter()
+            await cache.get()
+            latencies.append(time.perf_counter() - start_time)
+
+    stop = asyncio.Event()
+    lags: List[float] = []
+    ticker = asyncio.create_task(lag(stop, lags))
+    start_time = time.perf_counter()
+    await asyncio.gather(*[get() for _ in range(args.gets)])
+    wall = time.perf_counter() - start_time
+    # A config change is noticed within checkInterval
+    before = resolves(nixLog)
+    (confDir / "nix.conf").write_text("extra-platforms = i686-linux\n")
+    start_time = time.perf_counter()
+    while resolves(nixLog) == before:
+        await cache.get()
+        await asyncio.sleep(0.01)
+    noticed = time.perf_counter() - start_time
+    stop.set()
+    await ticker
+
+    latencies.sort()
+    return {
+        "startup_ms": startup * 1000,
+        "p50_us": latencies[len(latencies) // 2] * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6,
+        "per_second": len(latencies) / wall,
+        "max_lag_ms": max(lags, default=0) * 1000,
+        "change_ms": noticed * 1000,
+    }
+
+
+def main():
+    args = parse_args()
+    root = Path(tempfile.mkdtemp(prefix="nix-csi-bench-"))
+    os.environ["BENCH_NIX_LATENCY"] = str(args.nix_latency)
+    os.environ["BENCH_NIX_LOG"] = str(root / "nix.log")
+    (root / "nix.log").touch()
+    from bench import fakes
+
+    fakes.install_nix(root / "bin")
+    try:
+        for entries in args.entries:
+            confDir = root / f"conf-{entries}"
+            confDir.mkdir()
+            for i in range(entries):
+                (confDir / f"include-{i}.conf").write_text("")
+            r = asyncio.run(measure(confDir, root / "nix.log", args))
+            print(
+                f"{entries:>6} entries: startup {r['startup_ms']:.1f}ms,"
+                f" get p50 {r['p50_us']:.1f}us p99 {r['p99_us']:.1f}us"
+                f" {r['per_second']:.0f}/s, max loop lag {r['max_lag_ms']:.1f}ms,"
+                f" change noticed in {r['change_ms']:.0f}ms"
+            )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
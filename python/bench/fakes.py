@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from pathlib import Path
+from typing import Optional, Set
+
+# Stands in for the nix CLI. Answers what nix-csi asks of it, sleeping
+# BENCH_NIX_LATENCY seconds first and noting the call in BENCH_NIX_LOG.
+FAKE_NIX = """#!{python}
+import json, os, re, sys, time
+
+time.sleep(float(os.environ.get("BENCH_NIX_LATENCY", "0")))
+args = sys.argv[1:]
+if "BENCH_NIX_LOG" in os.environ:
+    with open(os.environ["BENCH_NIX_LOG"], "a") as log:
+        log.write(" ".join(args[:2]) + "\\n")
+if args[:2] in (["config", "show"], ["show-config"]):
+    print(json.dumps({{"system": {{"value": "x86_64-linux"}}}}))
+elif args[:1] == ["repl"]:
+    # Only pays the latency once, that's the point of keeping it around
+    print("Welcome to Nix. Type :? for help.", flush=True)
+    for line in sys.stdin:
+        if "import " in line:
+            text = open(line.split("import ")[1].split()[0]).read()
+            line = line.split("${{")[0] + re.search(r'"(/[^"]+)"', text).group(1) + '"'
+        print("nix-repl> " + line.strip().replace('" + "', ""), flush=True)
+elif args[:1] in (["eval"], ["build"]):
+    # Expressions name the store path they evaluate to
+    if "--expr" in args:
+        expr = args[args.index("--expr") + 1]
+        text = open(expr.split()[1]).read()
+        print(re.search(r'"(/[^"]+)"', text).group(1))
+    else:
+        print([a for a in args if a.startswith("/")][-1])
+"""
+
+
+def install_nix(binDir: Path):
+    binDir.mkdir(parents=True, exist_ok=True)
+    nix = binDir / "nix"
+    nix.write_text(FAKE_NIX.format(python=sys.executable))
+    nix.chmod(0o755)
+    os.environ["PATH"] = f"{binDir}:{os.environ['PATH']}"
+
+
+class FakeMounts:
+    """Mount table kept in memory, every operation sleeps latency seconds"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.points: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def mounted(self, path: Path) -> bool:
+        with self.lock:
+            return str(path) in self.points
+
+    def mount(self, target: Path):
+        time.sleep(self.latency)
+        with self.lock:
+            self.points.add(str(target))
+
+    def bind_readonly(self, source: Path, target: Path):
+        if not self.mounted(target):
+            self.mount(target)
+
+    def overlay(self, lowerdir: Path, upperdir: Path, workdir: Path, target: Path):
+        if not self.mounted(target):
+            self.mount(target)
+
+    def unmount(self, target: Path) -> bool:
+        time.sleep(self.latency)
+        with self.lock:
+            if str(target) not in self.points:
+                return False
+            self.points.discard(str(target))
+            return True
+
+
+def install(latency: float, jobLatency: float):
+    """Replace mounts, build Jobs and binary cache queries in nix_csi"""
+    from nix_csi import mounts, runbuild, substitute
+
+    fake = FakeMounts(latency)
+    mounts.mounted = fake.mounted
+    mounts.bind_readonly = fake.bind_readonly
+    mounts.overlay = fake.overlay
+    mounts.unmount = fake.unmount
+
+    async def run(storePath: str, expression: str):
+        await asyncio.sleep(jobLatency)
+        # Failing makes the driver build locally with the fake nix
+        return (False, "")
+
+    runbuild.run = run
+
+    async def find(storePath: Path, substituters) -> Optional[str]:
+        return None
+
+    substitute.NARINFO.find = find
+    return fake
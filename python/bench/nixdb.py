@@ -0,0 +1,111 @@
+"""
+Time creating volume databases for closures of different sizes with
+nix-store --dump-db | nix-store --load-db like nix_init_db did, with
+write_db and from a snapshot. The load-db baseline needs nix-store on
+PATH and is skipped without it. Run from the python directory:
+
+    python -m bench.nixdb --sizes 10 1000 10000
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from pathlib import Path
+from typing import List
+
+
+def store_args(storeDir: Path, stateDir: Path) -> List[str]:
+    # build-users-group would have to exist when running as root
+    return [
+        "--store",
+        f"local?store={storeDir}&state={stateDir}",
+        "--option",
+        "build-users-group",
+        "",
+    ]
+
+
+def load_db(stateDir: Path, paths: List[str], storeDir: Path, hostStateDir: Path):
+    """The nix_init_db pipeline write_db replaced"""
+    dump = subprocess.Popen(
+        ["nix-store", *store_args(storeDir, hostStateDir), "--dump-db", *paths],
+        stdout=subprocess.PIPE,
+    )
+    assert dump.stdout is not None
+    try:
+        subprocess.run(
+            ["nix-store", *store_args(storeDir, stateDir), "--load-db"],
+            stdin=dump.stdout,
+            check=True,
+        )
+    finally:
+        dump.stdout.close()
+    if dump.wait() != 0:
+        raise subprocess.CalledProcessError(dump.returncode, dump.args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi volume database benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    root = Path(tempfile.mkdtemp(prefix="nix-csi-bench-"))
+    os.environ["NIX_CSI_HOST_STATE_DIR"] = str(root / "var/nix")
+    from bench import store
+    from nix_csi import closure, nixdb
+
+    try:
+        # Paths only reference earlier ones, so the first n are a closure
+        store.build_store(root, max(args.sizes), 0, args.fanout, 0, seed=0)
+        index = closure.ClosureIndex(root / "var/nix")
+        index.reload()
+        everything = sorted(index.ids, key=index.ids.get)
+        nixdb.create_template(root / "template", root / "var/nix")
+        snapshots = nixdb.SnapshotCache(root / "snapshots")
+        snapshots.load()
+
+        for size in args.sizes:
+            paths = index.closure(everything[:size])
+            timings = {"write": [], "snapshot": []}
+            if shutil.which("nix-store"):
+                timings["load-db"] = []
+            for i in range(args.rounds):
+                for kind in timings:
+                    stateDir = root / f"vol-{size}-{kind}-{i}"
+                    start_time = time.perf_counter()
+                    if kind == "load-db":
+                        load_db(stateDir, paths, root / "store", root / "var/nix")
+                    elif kind == "write":
+                        nixdb.write_db(stateDir, paths, root / "template", root / "var/nix")
+                    else:
+                        nixdb.build_db(stateDir, paths, root / "template", snapshots, f"root-{size}")
+                    timings[kind].append(time.perf_counter() - start_time)
+                    shutil.rmtree(stateDir)
+            # The first snapshot round writes the snapshot
+            loadDb = (
+                f"{min(timings['load-db']) * 1000:8.1f}ms"
+                if "load-db" in timings
+                else "skipped, no nix-store"
+            )
+            print(
+                f"{len(paths):>6} paths: load-db {loadDb},"
+                f" write {min(timings['write']) * 1000:8.1f}ms,"
+                f" snapshot {min(timings['snapshot'][1:] or timings['snapshot']) * 1000:8.1f}ms"
+            )
+    finally:
+        for directory, _, _ in os.walk(root):
+            os.chmod(directory, 0o755)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
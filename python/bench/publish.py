@@ -0,0 +1,229 @@
+"""
+Publish/unpublish load test against a synthetic Nix store, no cluster,
+Nix or root needed. Run from the python directory:
+
+    python -m bench.publish --volumes 200 --concurrency 32
+
+nix, nix-daemon, mount(2) and build Jobs are replaced by stand-ins with
+configurable latency, everything else is the real driver talking grpc over
+a unix socket.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+
+from pathlib import Path
+from typing import List
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi publish benchmark")
+    parser.add_argument("--paths", type=int, default=200, help="store paths in the pool")
+    parser.add_argument("--files", type=int, default=20, help="files per store path")
+    parser.add_argument("--fanout", type=int, default=8, help="references per path")
+    parser.add_argument("--roots", type=int, default=10, help="distinct volume packages")
+    parser.add_argument("--volumes", type=int, default=100, help="volumes to publish")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--readwrite", type=float, default=0.5, help="share of overlay volumes")
+    parser.add_argument("--expressions", type=float, default=0.0, help="share of expression volumes")
+    parser.add_argument("--nix-latency", type=float, default=0.05)
+    parser.add_argument("--daemon-latency", type=float, default=0.0005)
+    parser.add_argument("--no-daemon", action="store_true", help="don't start the nix-daemon stand-in")
+    parser.add_argument("--mount-latency", type=float, default=0.001)
+    parser.add_argument("--job-latency", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the temp directory")
+    return parser.parse_args()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summary(latencies: List[float], wall: float) -> dict:
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0,
+        "per_second": len(latencies) / wall if wall else 0,
+    }
+
+
+async def run(args, root: Path) -> dict:
+    from bench import fakes, store
+
+    # Point the driver at the temp dir before it's imported
+    os.environ["NIX_CSI_ROOT"] = str(root / "csi")
+    os.environ["NIX_CSI_GCROOTS"] = str(root / "gcroots")
+    os.environ["NIX_CSI_HOST_STATE_DIR"] = str(root / "var/nix")
+    os.environ["NIX_CONF_DIR"] = str(root / "etc/nix")
+    os.environ["NIX_DAEMON_SOCKET_PATH"] = str(root / "daemon.sock")
+    os.environ["BENCH_NIX_LATENCY"] = str(args.nix_latency)
+    os.environ["BENCH_NIX_LOG"] = str(root / "nix.log")
+    os.environ.setdefault("KUBE_NAMESPACE", "bench")
+    (root / "etc/nix").mkdir(parents=True)
+    fakes.install_nix(root / "bin")
+
+    start_time = time.perf_counter()
+    roots = store.build_store(
+        root, args.paths, args.files, args.fanout, args.roots, args.seed
+    )
+    storeSeconds = time.perf_counter() - start_time
+    from bench import daemon
+
+    fakeDaemon = daemon.FakeDaemon(
+        root / "daemon.sock", root / "var/nix/db/db.sqlite", args.daemon_latency
+    )
+    if not args.no_daemon:
+        fakeDaemon.start()
+
+    from grpclib.client import Channel
+    from grpclib.server import Server
+    from csi import csi_grpc, csi_pb2
+    from nix_csi import closure, facts, nixdb, service
+
+    fakes.install(args.mount_latency, args.job_latency)
+
+    # What serve() does, minus NIX_PATH and the cluster
+    await service.REAPER.start()
+    for path in [
+        service.CSI_VOLUMES,
+        service.CSI_STAGED,
+        service.CSI_STAGES,
+        service.CSI_GCROOTS,
+    ]:
+        path.mkdir(parents=True, exist_ok=True)
+    nixdb.create_template(service.CSI_DB_TEMPLATE)
+    service.NodeServicer.dbSnapshots.load()
+    await asyncio.to_thread(closure.CLOSURES.reload)
+    await facts.NODE_FACTS.refresh()
+    closureSizes = [len(closure.CLOSURES.closure([r])) for r in roots]
+    nixLog = root / "nix.log"
+    nixLog.touch()
+
+    socketPath = str(root / "csi.sock")
+    server = Server([service.NodeServicer()])
+    await server.start(path=socketPath)
+    channel = Channel(path=socketPath)
+    node = csi_grpc.NodeStub(channel)
+
+    rng = random.Random(args.seed)
+    volumes = []
+    for i in range(args.volumes):
+        package = rng.choice(roots)
+        if rng.random() < args.expressions:
+            # Unique text per volume, so each one is evaluated
+            context = {"expression": f'{{ ... }}: "{package}" # {i}'}
+        else:
+            context = {"x86_64-linux": package}
+        volumes.append(
+            csi_pb2.NodePublishVolumeRequest(
+                volume_id=f"vol-{i}",
+                target_path=str(root / "targets" / f"vol-{i}"),
+                readonly=rng.random() >= args.readwrite,
+                volume_context=context,
+            )
+        )
+
+    limit = asyncio.Semaphore(args.concurrency)
+    publishes: List[float] = []
+    unpublishes: List[float] = []
+
+    async def publish(request):
+        async with limit:
+            start_time = time.perf_counter()
+            await node.NodePublishVolume(request)
+            publishes.append(time.perf_counter() - start_time)
+
+    async def unpublish(request):
+        async with limit:
+            start_time = time.perf_counter()
+            await node.NodeUnpublishVolume(
+                csi_pb2.NodeUnpublishVolumeRequest(
+                    volume_id=request.volume_id, target_path=request.target_path
+                )
+            )
+            unpublishes.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[publish(v) for v in volumes])
+    publishWall = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[unpublish(v) for v in volumes])
+    unpublishWall = time.perf_counter() - start_time
+    await service.REAPER.join()
+
+    channel.close()
+    server.close()
+    await server.wait_closed()
+    service.daemon.DAEMON.close()
+    if not args.no_daemon:
+        fakeDaemon.stop()
+
+    return {
+        "store": {
+            "paths": args.paths + args.roots,
+            "files_per_path": args.files,
+            "mean_closure": statistics.fmean(closureSizes),
+            "build_seconds": storeSeconds,
+        },
+        "publish": summary(publishes, publishWall),
+        "unpublish": summary(unpublishes, unpublishWall),
+        "nix_processes": len(nixLog.read_text().splitlines()),
+        "daemon_ops": fakeDaemon.ops,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(results: dict):
+    s = results["store"]
+    print(
+        f"store: {s['paths']} paths, {s['files_per_path']} files each,"
+        f" mean closure {s['mean_closure']:.0f} paths, built in {s['build_seconds']:.1f}s"
+    )
+    for name in ["publish", "unpublish"]:
+        r = results[name]
+        print(
+            f"{name:>9}: {r['count']} calls, p50 {r['p50_ms']:.1f}ms,"
+            f" p99 {r['p99_ms']:.1f}ms, max {r['max_ms']:.1f}ms,"
+            f" {r['per_second']:.1f}/s"
+        )
+    print(f"      nix: {results['nix_processes']} processes, {results['daemon_ops']} daemon ops")
+    print(f" peak rss: {results['peak_rss_mb']:.1f} MiB")
+
+
+def main():
+    args = parse_args()
+    root = Path(tempfile.mkdtemp(prefix="nix-csi-bench-"))
+    try:
+        results = asyncio.run(run(args, root))
+    finally:
+        if not args.keep:
+            # Store paths are readonly
+            for directory, _, _ in os.walk(root):
+                os.chmod(directory, 0o755)
+            shutil.rmtree(root, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import random
+import sqlite3
+import time
+
+from contextlib import closing
+from pathlib import Path
+from typing import List
+
+# The tables of Nix's schema.sql that nix-csi reads
+SCHEMA = """
+create table if not exists ValidPaths (
+    id               integer primary key autoincrement not null,
+    path             text unique not null,
+    hash             text not null,
+    registrationTime integer not null,
+    deriver          text,
+    narSize          integer,
+    ultimate         integer,
+    sigs             text,
+    ca               text
+);
+create table if not exists Refs (
+    referrer  integer not null,
+    reference integer not null,
+    primary key (referrer, reference),
+    foreign key (referrer) references ValidPaths(id) on delete cascade,
+    foreign key (reference) references ValidPaths(id) on delete restrict
+);
+create index if not exists IndexReferrer on Refs(referrer);
+create index if not exists IndexReference on Refs(reference);
+create table if not exists DerivationOutputs (
+    drv  integer not null,
+    id   text not null,
+    path text not null,
+    primary key (drv, id),
+    foreign key (drv) references ValidPaths(id) on delete cascade
+);
+create index if not exists IndexDerivationOutputs on DerivationOutputs(path);
+"""
+
+NIX_BASE32 = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def store_hash(seed: str) -> str:
+    digest = hashlib.sha256(seed.encode()).digest()
+    return "".join(NIX_BASE32[b % 32] for b in digest[:32])
+
+
+def nix32(data: bytes) -> str:
+    """Nix's base32, last byte first, so real Nix can parse our hashes"""
+    chars = []
+    for n in reversed(range((len(data) * 8 - 1) // 5 + 1)):
+        i, j = divmod(n * 5, 8)
+        c = data[i] >> j
+        if i + 1 < len(data):
+            c |= data[i + 1] << (8 - j)
+        chars.append(NIX_BASE32[c & 0x1F])
+    return "".join(chars)
+
+
+def make_path(storePath: Path, files: int):
+    """A store path with files spread over subdirectories and a symlink"""
+    (storePath / "bin").mkdir(parents=True)
+    for i in range(files):
+        directory = storePath / "share" / f"{i // 32}"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"file-{i}").write_bytes(os.urandom(64))
+    (storePath / "bin" / "run").write_text("#! /bin/sh\n")
+    (storePath / "bin" / "alias").symlink_to("run")
+    # Store paths are readonly
+    for directory, _, _ in os.walk(storePath):
+        os.chmod(directory, 0o555)
+
+
+def build_store(
+    root: Path,
+    paths: int,
+    files: int,
+    fanout: int,
+    roots: int,
+    seed: int = 0,
+) -> List[str]:
+    """
+    Create a store under root/store and its Nix database under
+    root/var/nix. The store is a random DAG of paths each referencing up to
+    fanout earlier paths, plus roots packages referencing fanout paths each.
+    Returns the root packages.
+    """
+    rng = random.Random(seed)
+    store = root / "store"
+    store.mkdir(parents=True)
+    dbDir = root / "var/nix/db"
+    dbDir.mkdir(parents=True)
+
+    with closing(sqlite3.connect(dbDir / "db.sqlite")) as db:
+        db.executescript(SCHEMA)
+        ids: List[int] = []
+
+        def register(name: str, references: List[int]) -> str:
+            path = store / f"{store_hash(f'{seed}-{name}')}-{name}"
+            make_path(path, files)
+            id = db.execute(
+                "INSERT INTO ValidPaths (path, hash, registrationTime, narSize)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    str(path),
+                    f"sha256:{nix32(hashlib.sha256(name.encode()).digest())}",
+                    int(time.time()),
+                    files * 64,
+                ),
+            ).lastrowid
+            assert id is not None
+            db.executemany(
+                "INSERT INTO Refs (referrer, reference) VALUES (?, ?)",
+                [(id, reference) for reference in [id, *references]],
+            )
+            ids.append(id)
+            return str(path)
+
+        for i in range(paths):
+            register(f"dep-{i}", rng.sample(ids, min(len(ids), rng.randint(0, fanout))))
+        rootPaths = [
+            register(f"root-{i}", rng.sample(ids[:paths], min(paths, fanout)))
+            for i in range(roots)
+        ]
+        db.commit()
+    return rootPaths
@@ -4,12 +4,10 @@
   csi-proto-python, # CSI GRPC bindings
   gitMinimal, # Lix requires Git CLI since it doesn't use libgit2
   lix, # We need a Nix implementation.... :)
-  nix_init_db, # Import from one nix DB to another
   openssh, # Copying to cache
-  rsync, # hardlinking
-  util-linuxMinimal, # mount, umount
-  coreutils, # ln
   kr8s, # Kubernetes API
+  httpx, # Binary cache queries
+  prometheus-client, # Metrics
 }:
 let
   pyproject = builtins.fromTOML (builtins.readFile ./pyproject.toml);
@@ -24,12 +22,10 @@ buildPythonApplication {
     csi-proto-python
     gitMinimal
     lix
-    nix_init_db
     openssh
-    rsync
-    util-linuxMinimal
-    coreutils
     kr8s
+    httpx
+    prometheus-client
   ];
   meta.mainProgram = "nix-csi";
 }
@@ -0,0 +1,102 @@
+import asyncio
+import functools
+import os
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Callable, TypeVar
+
+T = TypeVar("T")
+
+# Small filesystem calls, kept apart from the pools doing bulk work so a
+# big materialize or delete can't starve them
+FS_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="aiofs")
+
+
+async def run(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking call on the filesystem pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        FS_POOL, functools.partial(fn, *args, **kwargs)
+    )
+
+
+async def exists(path: Path) -> bool:
+    return await run(path.exists)
+
+
+async def is_symlink(path: Path) -> bool:
+    return await run(path.is_symlink)
+
+
+async def readlink(path: Path) -> Path:
+    return Path(await run(os.readlink, path))
+
+
+async def mkdir(path: Path):
+    await run(path.mkdir, parents=True, exist_ok=True)
+
+
+async def touch(path: Path):
+    await run(path.touch)
+
+
+async def unlink(path: Path):
+    await run(path.unlink, missing_ok=True)
+
+
+async def read_text(path: Path) -> str:
+    return await run(path.read_text)
+
+
+async def copy(src: Path, dst: Path):
+    await run(shutil.copy2, src, dst)
+
+
+def has_entries(path: Path) -> bool:
+    try:
+        with os.scandir(path) as entries:
+            return any(True for _ in entries)
+    except FileNotFoundError:
+        return False
+
+
+async def is_empty(path: Path) -> bool:
+    """True if path is an empty or missing directory"""
+    return not await run(has_entries, path)
+
+
+def force_symlink(link: Path, target: Path):
+    """Point link at target, replacing whatever was there"""
+    if link.is_symlink() and os.readlink(link) == str(target):
+        return
+    tmp = link.with_name(f".{link.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+
+
+async def symlink(link: Path, target: Path):
+    """Like ln --force --symbolic target link"""
+    await run(force_symlink, link, target)
+
+
+def write_temp(text: str, suffix: str) -> Path:
+    fd, name = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    return Path(name)
+
+
+@asynccontextmanager
+async def temp_file(text: str, suffix: str = "") -> AsyncIterator[Path]:
+    """Temporary file holding text, removed on exit"""
+    path = await run(write_temp, text, suffix)
+    try:
+        yield path
+    finally:
+        await unlink(path)
+
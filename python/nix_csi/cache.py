@@ -0,0 +1,137 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Optional
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+
+def normalize_expression(expression: str) -> str:
+    """
+    Normalize what can't change what an expression evaluates to: line
+    endings and blank lines before and after it. Everything else may be
+    part of a string, ''-strings keep trailing whitespace.
+    """
+    lines = expression.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    return "\n".join(lines)
+
+
+def expression_key(expression: str, *context: str) -> str:
+    """
+    Compact cache and lock key for an inline expression. context is what
+    else the result depends on, like NIX_PATH and the system.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in [normalize_expression(expression), *context]:
+        digest.update(part.encode())
+        # Keeps ("ab", "c") and ("a", "bc") apart
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResolutionCache:
+    """
+    Maps volume attributes (expression hashes, storePaths) to the store path
+    they resolved to. Lives in SQLite under CSI_ROOT so the mapping survives
+    restarts of the CSI pod. Entries are only returned if the store path
+    still exists and, if the caller passes maxAge, was resolved less than
+    maxAge seconds ago. The least recently used entries are evicted once
+    we hold more than maxEntries.
+    """
+
+    def __init__(self, dbPath: Path, maxEntries: int = 10000):
+        self.dbPath = dbPath
+        self.maxEntries = maxEntries
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.db is not None:
+            return self.db
+        try:
+            self.db = self.open()
+        except sqlite3.DatabaseError as ex:
+            # It's a cache, start over rather than fail
+            logger.warning(f"Resetting resolution cache {self.dbPath}: {ex}")
+            for suffix in ["", "-wal", "-shm"]:
+                Path(f"{self.dbPath}{suffix}").unlink(missing_ok=True)
+            self.db = self.open()
+        return self.db
+
+    def open(self) -> sqlite3.Connection:
+        self.dbPath.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.dbPath, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS Resolutions ("
+                " key TEXT PRIMARY KEY NOT NULL,"
+                " storePath TEXT NOT NULL,"
+                " atime INTEGER NOT NULL,"
+                " ctime INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in db.execute("PRAGMA table_info(Resolutions)")]
+            if "ctime" not in columns:
+                # Caches from before entries could expire, treated as expired
+                db.execute(
+                    "ALTER TABLE Resolutions ADD COLUMN ctime INTEGER NOT NULL DEFAULT 0"
+                )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS IndexAtime ON Resolutions(atime)"
+            )
+        return db
+
+    def get(self, key: str, maxAge: Optional[float] = None) -> Optional[Path]:
+        with self.lock:
+            db = self.connect()
+            row = db.execute(
+                "SELECT storePath, ctime FROM Resolutions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                metrics.cache_lookup("resolution", False)
+                return None
+            expired = maxAge is not None and row[1] < time.time_ns() - maxAge * 1e9
+            with db:
+                if expired or not os.path.exists(row[0]):
+                    db.execute("DELETE FROM Resolutions WHERE key = ?", (key,))
+                    metrics.cache_lookup("resolution", False)
+                    return None
+                db.execute(
+                    "UPDATE Resolutions SET atime = ? WHERE key = ?",
+                    (time.time_ns(), key),
+                )
+            metrics.cache_lookup("resolution", True)
+            return Path(row[0])
+
+    def put(self, key: str, storePath: Path):
+        with self.lock:
+            db = self.connect()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO Resolutions (key, storePath, atime, ctime)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, str(storePath), time.time_ns(), time.time_ns()),
+                )
+                db.execute(
+                    "DELETE FROM Resolutions WHERE key IN ("
+                    " SELECT key FROM Resolutions ORDER BY atime DESC"
+                    " LIMIT -1 OFFSET ?)",
+                    (self.maxEntries,),
+                )
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
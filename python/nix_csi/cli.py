@@ -1,7 +1,8 @@
 import asyncio
 import logging
 import argparse
-from . import service
+import os
+from . import evaluator, service, stages
 
 
 def parse_args():
@@ -12,6 +13,44 @@ def parse_args():
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="Set the logging level (default: INFO)",
     )
+    for stage, limit in stages.DEFAULT_LIMITS.items():
+        env = f"NIX_CSI_{stage.upper()}_CONCURRENCY"
+        parser.add_argument(
+            f"--{stage}-concurrency",
+            type=int,
+            default=int(os.environ.get(env, limit)),
+            help=f"Concurrent publishes in the {stage} stage (env: {env}, default: {limit})",
+        )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=int(os.environ.get("NIX_CSI_METRICS_PORT", 0)),
+        help="Serve Prometheus metrics on this port, 0 disables (env: NIX_CSI_METRICS_PORT)",
+    )
+    parser.add_argument(
+        "--evaluators",
+        type=int,
+        default=int(os.environ.get("NIX_CSI_EVALUATORS", 2)),
+        help="Warm nix repl processes for expression volumes, 0 runs nix eval per expression (env: NIX_CSI_EVALUATORS)",
+    )
+    parser.add_argument(
+        "--evaluator-max-evals",
+        type=int,
+        default=int(os.environ.get("NIX_CSI_EVALUATOR_MAX_EVALS", 100)),
+        help="Replace an evaluator after this many evaluations (env: NIX_CSI_EVALUATOR_MAX_EVALS)",
+    )
+    parser.add_argument(
+        "--evaluator-max-rss",
+        type=int,
+        default=int(os.environ.get("NIX_CSI_EVALUATOR_MAX_RSS", 4096)),
+        help="Replace an evaluator once it uses this many MiB (env: NIX_CSI_EVALUATOR_MAX_RSS)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action=argparse.BooleanOptionalAction,
+        default=os.environ.get("NIX_CSI_PREFETCH") == "true",
+        help="Prepare volumes of Pods scheduled to this node before they're published (env: NIX_CSI_PREFETCH)",
+    )
     return parser.parse_args()
 
 
@@ -26,8 +65,18 @@ async def async_main():
     logger.info(f"Current log level: {loglevel_str}")
 
     logging.getLogger("nix-csi").setLevel(getattr(logging, args.loglevel))
+    stages.PIPELINE.configure(
+        {
+            stage: getattr(args, f"{stage}_concurrency")
+            for stage in stages.DEFAULT_LIMITS
+        }
+    )
+
+    evaluator.POOL.configure(
+        args.evaluators, args.evaluator_max_evals, args.evaluator_max_rss << 20
+    )
 
-    await service.serve()
+    await service.serve(args.metrics_port, args.prefetch)
 
 
 def main():
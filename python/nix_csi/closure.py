@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+from .nixdb import HOST_STATE_DIR, connect_host
+
+logger = logging.getLogger("nix-csi")
+
+
+class ClosureError(Exception):
+    pass
+
+
+class ClosureIndex:
+    """
+    In-memory reference graph of the hosts Nix database. The database is
+    only read when SQLite reports another connection has committed since we
+    last looked, new registrations are added incrementally and deletions
+    (garbage collection) trigger a full reload.
+    """
+
+    def __init__(self, hostStateDir: Path = HOST_STATE_DIR):
+        self.hostStateDir = hostStateDir
+        self.db: Optional[sqlite3.Connection] = None
+        self.dataVersion: Optional[int] = None
+        self.lastId = 0
+        self.ids: Dict[str, int] = {}
+        self.paths: Dict[int, str] = {}
+        self.derivers: Dict[int, str] = {}
+        self.refs: Dict[int, List[int]] = {}
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            # Queries run on whichever worker thread, serialized by self.lock
+            self.db = connect_host(self.hostStateDir, check_same_thread=False)
+        return self.db
+
+    def clear(self):
+        # Caller holds the lock
+        self.dataVersion = None
+        self.lastId = 0
+        self.ids.clear()
+        self.paths.clear()
+        self.derivers.clear()
+        self.refs.clear()
+
+    def reload(self):
+        start_time = time.perf_counter()
+        with self.lock:
+            self.clear()
+            self.update()
+        logger.info(
+            f"Indexed {len(self.paths)} store paths in {time.perf_counter() - start_time:.3f} seconds"
+        )
+
+    def update(self):
+        # Caller holds the lock
+        db = self.connect()
+        dataVersion = db.execute("PRAGMA data_version").fetchone()[0]
+        if dataVersion == self.dataVersion:
+            return
+        with db:
+            db.execute("BEGIN")
+            rows = db.execute(
+                "SELECT id, path, deriver FROM ValidPaths WHERE id > ?",
+                (self.lastId,),
+            ).fetchall()
+            refs = db.execute(
+                "SELECT referrer, reference FROM Refs WHERE referrer > ?",
+                (self.lastId,),
+            ).fetchall()
+            count = db.execute("SELECT count(*) FROM ValidPaths").fetchone()[0]
+        for id, path, deriver in rows:
+            self.ids[path] = id
+            self.paths[id] = path
+            if deriver is not None:
+                self.derivers[id] = deriver
+            self.lastId = max(self.lastId, id)
+        for referrer, reference in refs:
+            self.refs.setdefault(referrer, []).append(reference)
+        self.dataVersion = dataVersion
+        if count != len(self.paths):
+            # Paths were deleted, ids are never reused so start over
+            logger.debug("Store paths removed, reindexing")
+            self.clear()
+            self.update()
+
+    def closure_ids(self, ids: Iterable[int]) -> List[int]:
+        # Caller holds the lock
+        seen = set(ids)
+        stack = list(seen)
+        while stack:
+            for reference in self.refs.get(stack.pop(), ()):
+                if reference not in seen:
+                    seen.add(reference)
+                    stack.append(reference)
+        return list(seen)
+
+    def lookup(self, paths: Iterable[str]) -> List[int]:
+        # Caller holds the lock
+        ids = []
+        for path in paths:
+            id = self.ids.get(str(path))
+            if id is None:
+                raise ClosureError(f"{path} is not a valid store path")
+            ids.append(id)
+        return ids
+
+    def closure(self, paths: Iterable[str]) -> List[str]:
+        """Like nix path-info --recursive"""
+        with self.lock:
+            self.update()
+            return [self.paths[id] for id in self.closure_ids(self.lookup(paths))]
+
+    def derivation_closure(self, paths: Iterable[str]) -> List[str]:
+        """Like nix path-info --recursive --derivation"""
+        with self.lock:
+            self.update()
+            drvs = []
+            for path in paths:
+                path = str(path)
+                if not path.endswith(".drv"):
+                    deriver = self.derivers.get(self.lookup([path])[0])
+                    if deriver is None:
+                        raise ClosureError(f"{path} has no known deriver")
+                    path = deriver
+                drvs.append(path)
+            return [self.paths[id] for id in self.closure_ids(self.lookup(drvs))]
+
+    def deriver(self, path: str) -> str:
+        # Caller holds the lock
+        if path.endswith(".drv"):
+            return path
+        id = self.ids.get(path)
+        deriver = self.derivers.get(id) if id is not None else None
+        if deriver is None:
+            # Outputs that haven't been built are only in DerivationOutputs
+            row = (
+                self.connect()
+                .execute(
+                    "SELECT v.path FROM DerivationOutputs o"
+                    " JOIN ValidPaths v ON v.id = o.drv WHERE o.path = ?",
+                    (path,),
+                )
+                .fetchone()
+            )
+            if row is None:
+                raise ClosureError(f"{path} has no known deriver")
+            deriver = row[0]
+        return deriver
+
+    def input_closure(self, paths: Iterable[str]) -> List[str]:
+        """
+        Store paths a build of paths needs: the outputs of the input
+        derivations, the input sources and whatever of their runtime
+        closures we know about.
+        """
+        with self.lock:
+            self.update()
+            drvs = self.lookup(self.deriver(str(path)) for path in paths)
+            inputDrvs = []
+            inputs = set()
+            for id in drvs:
+                for reference in self.refs.get(id, ()):
+                    if self.paths[reference].endswith(".drv"):
+                        inputDrvs.append(reference)
+                    else:
+                        inputs.add(reference)
+            outputs = set()
+            db = self.connect()
+            for i in range(0, len(inputDrvs), 500):
+                chunk = inputDrvs[i : i + 500]
+                outputs.update(
+                    path
+                    for (path,) in db.execute(
+                        "SELECT path FROM DerivationOutputs"
+                        f" WHERE drv IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+            inputs.update(self.ids[path] for path in outputs if path in self.ids)
+            closure = {self.paths[id] for id in self.closure_ids(inputs)}
+            return sorted(closure | outputs)
+
+    def all_paths(self) -> List[str]:
+        with self.lock:
+            self.update()
+            return list(self.paths.values())
+
+    async def query(self, paths: Iterable[str], derivation: bool = False) -> List[str]:
+        """Resolve a closure on a worker thread, in case we have to reindex"""
+        fn = self.derivation_closure if derivation else self.closure
+        return await asyncio.to_thread(fn, list(paths))
+
+
+CLOSURES = ClosureIndex()
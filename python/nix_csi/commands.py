@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import shlex
+import time
+
+from typing import Optional
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+# Bytes kept per stream. stdout is what callers parse so it gets plenty,
+# stderr and the interleaved output only end up in error messages.
+STDOUT_LIMIT = 4 * 1024 * 1024
+STDERR_LIMIT = 64 * 1024
+COMBINED_LIMIT = 64 * 1024
+READ_SIZE = 64 * 1024
+
+
+def log_command(*args, log_level: int):
+    logger.log(
+        log_level,
+        f"Running command: {shlex.join([str(arg) for arg in args])}",
+    )
+
+
+class RingBuffer:
+    """Keeps the last limit bytes written to it, None keeps everything"""
+
+    __slots__ = ("data", "limit", "truncated")
+
+    def __init__(self, limit: Optional[int]):
+        self.data = bytearray()
+        self.limit = limit
+        self.truncated = False
+
+    def write(self, chunk: bytes):
+        self.data += chunk
+        # Trim in bulk rather than on every write
+        if self.limit is not None and len(self.data) > 2 * self.limit:
+            del self.data[: len(self.data) - self.limit]
+            self.truncated = True
+
+    def getvalue(self) -> bytes:
+        if self.limit is not None and len(self.data) > self.limit:
+            del self.data[: len(self.data) - self.limit]
+            self.truncated = True
+        return bytes(self.data)
+
+    def text(self) -> str:
+        return self.getvalue().decode(errors="replace").strip()
+
+
+class SubprocessResult:
+    """Output is only decoded when asked for"""
+
+    __slots__ = ("returncode", "elapsed", "stdoutBuffer", "stderrBuffer", "combinedBuffer")
+
+    def __init__(
+        self,
+        returncode: int,
+        stdoutBuffer: RingBuffer,
+        stderrBuffer: RingBuffer,
+        combinedBuffer: RingBuffer,
+        elapsed: float,
+    ):
+        self.returncode = returncode
+        self.stdoutBuffer = stdoutBuffer
+        self.stderrBuffer = stderrBuffer
+        self.combinedBuffer = combinedBuffer
+        self.elapsed = elapsed
+
+    @property
+    def stdout(self) -> str:
+        return self.stdoutBuffer.text()
+
+    @property
+    def stderr(self) -> str:
+        return self.stderrBuffer.text()
+
+    @property
+    def combined(self) -> str:
+        return self.combinedBuffer.text()
+
+
+# Run async subprocess, capture output and returncode
+async def run_captured(*args, stdoutLimit: Optional[int] = STDOUT_LIMIT):
+    return await run_console(*args, log_level=logging.NOTSET, stdoutLimit=stdoutLimit)
+
+
+# Run async subprocess, forward output to console and return returncode
+async def run_console(
+    *args,
+    log_level: int = logging.DEBUG,
+    stdoutLimit: Optional[int] = STDOUT_LIMIT,
+):
+    start_time = time.perf_counter()
+    log_command(*args, log_level=log_level)
+    proc = await asyncio.create_subprocess_exec(
+        *[str(arg) for arg in args],
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    stdout_data = RingBuffer(stdoutLimit)
+    stderr_data = RingBuffer(STDERR_LIMIT)
+    combined_data = RingBuffer(COMBINED_LIMIT)
+    # Checked once, not for every line
+    logLines = logger.isEnabledFor(log_level)
+
+    def log_line(line: bytes):
+        logger.log(log_level, line.decode(errors="replace").strip())
+
+    async def stream_output(stream, buffer: RingBuffer):
+        # Start of a line we haven't seen the end of yet
+        partial = bytearray()
+        while chunk := await stream.read(READ_SIZE):
+            buffer.write(chunk)
+            combined_data.write(chunk)
+            if not logLines:
+                continue
+            lines = chunk.split(b"\n")
+            partial += lines[0]
+            if len(lines) > 1:
+                log_line(partial)
+                for line in lines[1:-1]:
+                    log_line(line)
+                partial = bytearray(lines[-1])
+            if len(partial) > READ_SIZE:
+                # Don't buffer endless lines just to log them
+                log_line(partial)
+                partial = bytearray()
+        if partial:
+            log_line(partial)
+
+    await asyncio.gather(
+        stream_output(proc.stdout, stdout_data),
+        stream_output(proc.stderr, stderr_data),
+        proc.wait(),
+    )
+    elapsed_time = time.perf_counter() - start_time
+    command = metrics.command_name(args)
+    metrics.SUBPROCESS_SECONDS.labels(command).observe(elapsed_time)
+    if proc.returncode != 0:
+        metrics.SUBPROCESS_FAILURES.labels(command).inc()
+    if elapsed_time > 5:
+        logger.info(
+            f"Comamnd executed in {elapsed_time} seconds: {shlex.join([str(arg) for arg in args[:5]])}"
+        )
+
+    assert proc.returncode is not None
+    return SubprocessResult(
+        proc.returncode,
+        stdout_data,
+        stderr_data,
+        combined_data,
+        elapsed_time,
+    )
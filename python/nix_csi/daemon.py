@@ -0,0 +1,380 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Iterable, List, NamedTuple, Optional
+from . import aiofs, metrics
+
+logger = logging.getLogger("nix-csi")
+
+# Same variable the nix CLI honours
+DAEMON_SOCKET = Path(
+    os.environ.get("NIX_DAEMON_SOCKET_PATH", "/nix/var/nix/daemon-socket/socket")
+)
+GCROOTS_DIR = Path("/nix/var/nix/gcroots")
+
+WORKER_MAGIC_1 = 0x6E697863
+WORKER_MAGIC_2 = 0x6478696F
+# 1.35 is the newest version Lix speaks, newer Nix daemons negotiate down
+PROTOCOL_VERSION = (1 << 8) | 35
+MIN_PROTOCOL_VERSION = (1 << 8) | 21
+
+STDERR_NEXT = 0x6F6C6D67
+STDERR_READ = 0x64617461
+STDERR_WRITE = 0x64617416
+STDERR_LAST = 0x616C7473
+STDERR_ERROR = 0x63787470
+STDERR_START_ACTIVITY = 0x53545254
+STDERR_STOP_ACTIVITY = 0x53544F50
+STDERR_RESULT = 0x52534C54
+
+OP_IS_VALID_PATH = 1
+OP_BUILD_PATHS = 9
+OP_ADD_TEMP_ROOT = 11
+OP_ADD_INDIRECT_ROOT = 12
+OP_QUERY_PATH_INFO = 26
+
+OP_NAMES = {
+    OP_IS_VALID_PATH: "isValidPath",
+    OP_BUILD_PATHS: "buildPaths",
+    OP_ADD_TEMP_ROOT: "addTempRoot",
+    OP_ADD_INDIRECT_ROOT: "addIndirectRoot",
+    OP_QUERY_PATH_INFO: "queryPathInfo",
+}
+
+
+class DaemonError(Exception):
+    """An error the daemon reported, the connection is still usable"""
+
+    pass
+
+
+class DaemonUnavailable(Exception):
+    """We couldn't reach or understand the daemon"""
+
+    pass
+
+
+class PathInfo(NamedTuple):
+    path: str
+    deriver: Optional[str]
+    narHash: str
+    references: List[str]
+    registrationTime: int
+    narSize: int
+
+
+def minor(version: int) -> int:
+    return version & 0xFF
+
+
+def encode_int(value: int) -> bytes:
+    return struct.pack("<Q", value)
+
+
+def encode_string(value: str | bytes) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    return encode_int(len(value)) + value + b"\0" * (-len(value) % 8)
+
+
+def encode_strings(values: Iterable[str]) -> bytes:
+    values = list(values)
+    return encode_int(len(values)) + b"".join(encode_string(v) for v in values)
+
+
+class Connection:
+    """One worker protocol session with the daemon, used by one task at a time"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.version = 0
+        self.uses = 0
+
+    @classmethod
+    async def open(cls, socketPath: Path) -> "Connection":
+        reader, writer = await asyncio.open_unix_connection(str(socketPath))
+        conn = cls(reader, writer)
+        try:
+            await conn.handshake()
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def handshake(self):
+        self.writer.write(encode_int(WORKER_MAGIC_1))
+        await self.writer.drain()
+        if await self.read_int() != WORKER_MAGIC_2:
+            raise DaemonUnavailable("daemon protocol mismatch")
+        daemonVersion = await self.read_int()
+        if daemonVersion >> 8 != 1 or daemonVersion < MIN_PROTOCOL_VERSION:
+            raise DaemonUnavailable(f"unsupported daemon protocol {daemonVersion:#x}")
+        self.version = min(daemonVersion, PROTOCOL_VERSION)
+        # Our version, then the obsolete CPU affinity and reserveSpace
+        self.writer.write(encode_int(PROTOCOL_VERSION) + encode_int(0) + encode_int(0))
+        await self.writer.drain()
+        if minor(self.version) >= 33:
+            await self.read_string()  # daemon Nix version
+        if minor(self.version) >= 35:
+            await self.read_int()  # whether we're trusted
+        await self.process_stderr()
+
+    def close(self):
+        self.writer.close()
+
+    async def read_int(self) -> int:
+        return struct.unpack("<Q", await self.reader.readexactly(8))[0]
+
+    async def read_bytes(self) -> bytes:
+        length = await self.read_int()
+        data = await self.reader.readexactly(length + (-length % 8))
+        return data[:length]
+
+    async def read_string(self) -> str:
+        return (await self.read_bytes()).decode(errors="replace")
+
+    async def read_strings(self) -> List[str]:
+        return [await self.read_string() for _ in range(await self.read_int())]
+
+    async def read_fields(self):
+        for _ in range(await self.read_int()):
+            kind = await self.read_int()
+            if kind == 0:
+                await self.read_int()
+            elif kind == 1:
+                await self.read_string()
+            else:
+                raise DaemonUnavailable(f"unknown activity field type {kind}")
+
+    async def read_error(self) -> DaemonError:
+        if minor(self.version) < 26:
+            message = await self.read_string()
+            await self.read_int()  # exit status
+            return DaemonError(message)
+        await self.read_string()  # always "Error"
+        await self.read_int()  # verbosity
+        await self.read_string()  # unused name
+        message = await self.read_string()
+        await self.read_int()  # position, never sent
+        traces = []
+        for _ in range(await self.read_int()):
+            await self.read_int()  # position, never sent
+            traces.append(await self.read_string())
+        return DaemonError("\n".join([message, *traces]))
+
+    async def process_stderr(self):
+        """Consume log messages until the daemon is done with the operation"""
+        while True:
+            message = await self.read_int()
+            if message == STDERR_LAST:
+                return
+            elif message == STDERR_ERROR:
+                raise await self.read_error()
+            elif message in (STDERR_NEXT, STDERR_WRITE):
+                logger.debug(f"nix-daemon: {(await self.read_string()).strip()}")
+            elif message == STDERR_START_ACTIVITY:
+                await self.read_int()  # id
+                await self.read_int()  # level
+                await self.read_int()  # type
+                text = await self.read_string()
+                await self.read_fields()
+                await self.read_int()  # parent
+                if text:
+                    logger.debug(f"nix-daemon: {text}")
+            elif message == STDERR_STOP_ACTIVITY:
+                await self.read_int()
+            elif message == STDERR_RESULT:
+                await self.read_int()  # id
+                await self.read_int()  # type
+                await self.read_fields()
+            elif message == STDERR_READ:
+                # Only sent when we upload something, which we don't
+                raise DaemonUnavailable("daemon asked for data")
+            else:
+                raise DaemonUnavailable(f"unknown stderr message {message:#x}")
+
+    async def call(self, op: int, *args: bytes):
+        """Send an operation and wait for the daemon to start replying"""
+        self.uses += 1
+        self.writer.write(encode_int(op) + b"".join(args))
+        await self.writer.drain()
+        await self.process_stderr()
+
+    async def is_valid_path(self, path: str) -> bool:
+        await self.call(OP_IS_VALID_PATH, encode_string(path))
+        return bool(await self.read_int())
+
+    async def add_temp_root(self, path: str):
+        await self.call(OP_ADD_TEMP_ROOT, encode_string(path))
+        await self.read_int()
+
+    async def add_indirect_root(self, path: str):
+        await self.call(OP_ADD_INDIRECT_ROOT, encode_string(path))
+        await self.read_int()
+
+    async def build_paths(self, paths: Iterable[str]):
+        # Plain store paths are substituted, "drv!out" would be built
+        args = [encode_strings(paths)]
+        if minor(self.version) >= 15:
+            args.append(encode_int(0))  # bmNormal
+        await self.call(OP_BUILD_PATHS, *args)
+        await self.read_int()
+
+    async def query_path_info(self, path: str) -> Optional[PathInfo]:
+        try:
+            await self.call(OP_QUERY_PATH_INFO, encode_string(path))
+        except DaemonError:
+            if minor(self.version) >= 17:
+                raise
+            # Old daemons report invalid paths as errors
+            return None
+        if minor(self.version) >= 17 and not await self.read_int():
+            return None
+        deriver = await self.read_string()
+        narHash = await self.read_string()
+        references = await self.read_strings()
+        registrationTime = await self.read_int()
+        narSize = await self.read_int()
+        if minor(self.version) >= 16:
+            await self.read_int()  # ultimate
+            await self.read_strings()  # sigs
+            await self.read_string()  # content address
+        return PathInfo(
+            path, deriver or None, narHash, references, registrationTime, narSize
+        )
+
+
+class DaemonPool:
+    """
+    A few persistent connections to nix-daemon, so store queries don't cost
+    a nix process each. Connections are recycled after maxUses operations,
+    which also releases the temporary roots they've collected.
+    """
+
+    def __init__(
+        self, socketPath: Path = DAEMON_SOCKET, size: int = 4, maxUses: int = 1000
+    ):
+        self.socketPath = socketPath
+        self.maxUses = maxUses
+        self.idle: List[Connection] = []
+        self.slots = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Connection]:
+        async with self.slots:
+            conn = None
+            while self.idle and conn is None:
+                conn = self.idle.pop()
+                if conn.reader.at_eof():
+                    # The daemon hung up while it was idle, restarted or
+                    # gave up on the session after an error
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = await Connection.open(self.socketPath)
+            reusable = False
+            try:
+                yield conn
+                reusable = True
+            except DaemonError:
+                # The daemon finished the operation, just unsuccessfully
+                reusable = True
+                raise
+            finally:
+                if reusable and conn.uses < self.maxUses:
+                    self.idle.append(conn)
+                else:
+                    conn.close()
+
+    async def run(self, op: int, fn, *args):
+        start_time = time.perf_counter()
+        try:
+            async with self.connection() as conn:
+                return await fn(conn, *args)
+        except (asyncio.IncompleteReadError, OSError) as ex:
+            raise DaemonUnavailable(f"nix-daemon connection failed: {ex}") from ex
+        finally:
+            metrics.DAEMON_SECONDS.labels(OP_NAMES[op]).observe(
+                time.perf_counter() - start_time
+            )
+
+    async def is_valid_path(self, path: Path) -> bool:
+        return await self.run(OP_IS_VALID_PATH, Connection.is_valid_path, str(path))
+
+    async def query_path_info(self, path: Path) -> Optional[PathInfo]:
+        return await self.run(
+            OP_QUERY_PATH_INFO, Connection.query_path_info, str(path)
+        )
+
+    async def query_closure(self, paths: Iterable[Path]) -> List[str]:
+        """Like nix path-info --recursive, a level of the graph at a time"""
+        seen = {str(path) for path in paths}
+        frontier = list(seen)
+        while frontier:
+            infos = await asyncio.gather(
+                *[self.query_path_info(Path(path)) for path in frontier]
+            )
+            for path, info in zip(frontier, infos):
+                if info is None:
+                    raise DaemonError(f"{path} is not a valid store path")
+            frontier = []
+            for info in infos:
+                for reference in info.references:
+                    if reference not in seen:
+                        seen.add(reference)
+                        frontier.append(reference)
+        return list(seen)
+
+    async def add_temp_root(self, path: Path):
+        await self.run(OP_ADD_TEMP_ROOT, Connection.add_temp_root, str(path))
+
+    async def add_perm_root(self, path: Path, gcRoot: Path) -> Path:
+        """
+        Point gcRoot at path. Like Nix we hold a temporary root while doing
+        so, and register gcRoot as indirect root when it's not under
+        GCROOTS_DIR.
+        """
+        await self.add_temp_root(path)
+        await aiofs.symlink(gcRoot, path)
+        if not gcRoot.is_relative_to(GCROOTS_DIR):
+            await self.run(
+                OP_ADD_INDIRECT_ROOT, Connection.add_indirect_root, str(gcRoot)
+            )
+        return gcRoot
+
+    async def build_paths(self, paths: Iterable[Path]):
+        """Substitute store paths, raises DaemonError if that's not possible"""
+        await self.run(
+            OP_BUILD_PATHS, Connection.build_paths, [str(path) for path in paths]
+        )
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+DAEMON = DaemonPool()
+
+
+async def is_valid_path(path: Path) -> bool:
+    """Ask the daemon, or the filesystem if we can't reach it"""
+    try:
+        return await DAEMON.is_valid_path(path)
+    except DaemonUnavailable as ex:
+        logger.debug(f"{ex}, checking {path} on disk")
+        return await aiofs.exists(path)
+
+
+async def add_perm_root(path: Path, gcRoot: Path):
+    """Root path through the daemon, or by just creating the link"""
+    try:
+        await DAEMON.add_perm_root(path, gcRoot)
+    except DaemonUnavailable as ex:
+        logger.debug(f"{ex}, linking {gcRoot} without a temporary root")
+        await aiofs.symlink(gcRoot, path)
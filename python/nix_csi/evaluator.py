@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import re
+
+from pathlib import Path
+from typing import List
+from . import aiofs, metrics
+
+logger = logging.getLogger("nix-csi")
+
+REPL_COMMAND = ["nix", "repl"]
+# In case something ignores NO_COLOR
+ANSI_ESCAPE = re.compile(rb"\x1b\[[0-9;?]*[a-zA-Z]")
+# Lines of output kept for error messages
+OUTPUT_TAIL_LINES = 50
+
+
+class EvalError(Exception):
+    """The expression didn't evaluate, the evaluator is fine"""
+
+    pass
+
+
+class WorkerError(Exception):
+    """The evaluator died or stopped making sense"""
+
+    pass
+
+
+class Evaluator:
+    """
+    A nix repl process driven over pipes. Each request is followed by a
+    marker expression, everything printed before the marker's value is
+    the request's output. Markers are built by concatenation so the input
+    never contains what we're looking for, in case it's echoed.
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.evals = 0
+        self.counter = itertools.count()
+
+    @classmethod
+    async def start(cls) -> "Evaluator":
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *REPL_COMMAND,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                # Merged so errors arrive in order with everything else
+                stderr=asyncio.subprocess.STDOUT,
+                env={**os.environ, "NO_COLOR": "1", "TERM": "dumb"},
+            )
+        except OSError as ex:
+            raise WorkerError(f"failed to start nix repl: {ex}")
+        worker = cls(proc)
+        try:
+            # Past the welcome banner and ready for input
+            await worker.request("null")
+        except BaseException:
+            worker.stop()
+            raise
+        logger.debug(f"Started evaluator {proc.pid}")
+        return worker
+
+    async def request(self, line: str) -> List[bytes]:
+        """Send one line of input, return the output it caused"""
+        marker = next(self.counter)
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        self.proc.stdin.write(f'{line}\n"nix-csi-done-" + "{marker}"\n'.encode())
+        done = f'"nix-csi-done-{marker}"'.encode()
+        output: collections.deque[bytes] = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        try:
+            await self.proc.stdin.drain()
+            while True:
+                text = await self.proc.stdout.readline()
+                if not text:
+                    tail = b"".join(output).decode(errors="replace")
+                    raise WorkerError(f"nix repl exited: {tail}")
+                text = ANSI_ESCAPE.sub(b"", text)
+                if done in text:
+                    return list(output)
+                output.append(text)
+        except (OSError, ValueError) as ex:
+            # Broken pipe, or a line longer than the stream limit
+            raise WorkerError(f"nix repl failed: {ex}")
+
+    async def evaluate(self, expressionFile: Path) -> Path:
+        """The store path expressionFile evaluates to, like nix eval --raw"""
+        self.evals += 1
+        marker = next(self.counter)
+        output = await self.request(
+            f'"nix-csi-result-" + "{marker}:${{import {expressionFile} {{}}}}"'
+        )
+        result = re.compile(rf'"nix-csi-result-{marker}:([^"\s]+)"'.encode())
+        for text in output:
+            match = result.search(text)
+            if match:
+                return Path(match.group(1).decode())
+        raise EvalError(b"".join(output).decode(errors="replace").strip())
+
+    def rss(self) -> int:
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def stop(self):
+        # Nothing in there worth a graceful exit
+        if self.proc.returncode is None:
+            self.proc.kill()
+
+
+class EvaluatorPool:
+    """
+    Warm nix repl processes for expression volumes, so nixpkgs and
+    whatever else the expressions import are parsed once per evaluator
+    rather than once per eval. Evaluators are replaced after maxEvals
+    evaluations or when they grow past maxRss bytes, the evaluation cache
+    only ever grows.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        maxEvals: int = 100,
+        maxRss: int = 4 << 30,
+        timeout: float = 600,
+    ):
+        self.configure(size, maxEvals, maxRss)
+        self.timeout = timeout
+        self.idle: List[Evaluator] = []
+
+    def configure(self, size: int, maxEvals: int, maxRss: int):
+        # Only before we start serving, like stage limits
+        self.size = size
+        self.maxEvals = maxEvals
+        self.maxRss = maxRss
+        self.slots = asyncio.Semaphore(max(size, 1))
+
+    def recycle(self, worker: Evaluator) -> bool:
+        """Put worker back in the pool unless it's used up"""
+        reason = None
+        if worker.proc.returncode is not None:
+            reason = "exited"
+        elif worker.evals >= self.maxEvals:
+            reason = "evals"
+        elif worker.rss() >= self.maxRss:
+            reason = "rss"
+        if reason is None:
+            self.idle.append(worker)
+            return True
+        logger.debug(f"Replacing evaluator {worker.proc.pid}: {reason}")
+        metrics.EVALUATORS_RETIRED.labels(reason).inc()
+        worker.stop()
+        return False
+
+    async def evaluate(self, expression: str) -> Path:
+        # The evaluator caches files by path and temp file names get
+        # reused, the content hash keeps a reused name from hitting the cache
+        digest = hashlib.blake2b(expression.encode(), digest_size=16).hexdigest()
+        async with aiofs.temp_file(expression, f"-{digest}.nix") as expressionFile:
+            async with self.slots:
+                worker = self.idle.pop() if self.idle else await Evaluator.start()
+                reusable = False
+                try:
+                    result = await asyncio.wait_for(
+                        worker.evaluate(expressionFile), self.timeout
+                    )
+                    reusable = True
+                    return result
+                except EvalError:
+                    reusable = True
+                    raise
+                except asyncio.TimeoutError:
+                    raise WorkerError(f"evaluation timed out after {self.timeout}s")
+                finally:
+                    if reusable:
+                        self.recycle(worker)
+                    else:
+                        metrics.EVALUATORS_RETIRED.labels("failed").inc()
+                        worker.stop()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().stop()
+
+
+POOL = EvaluatorPool()
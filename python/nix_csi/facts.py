@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+from . import aiofs
+from .commands import run_captured
+
+logger = logging.getLogger("nix-csi")
+
+# nix.conf and friends, mounted from the nix-config ConfigMap
+NIX_CONF_DIR = Path(os.environ.get("NIX_CONF_DIR", "/etc/nix"))
+# Seconds between looks at NIX_CONF_DIR, kubelet takes a minute or so to
+# update ConfigMap volumes anyway
+CONF_CHECK_INTERVAL = 5
+
+
+class NodeFacts(NamedTuple):
+    system: str
+    extraPlatforms: List[str]
+    substituters: List[str]
+
+    @property
+    def systems(self) -> List[str]:
+        """Systems this node can run, in order of preference"""
+        return [self.system, *self.extraPlatforms]
+
+
+def conf_stamp(confDir: Path = NIX_CONF_DIR) -> Tuple:
+    """Cheap fingerprint of the Nix configuration directory"""
+    stamp = []
+    try:
+        entries = sorted(os.scandir(confDir), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return ()
+    for entry in entries:
+        try:
+            # Follows symlinks so ConfigMap "..data" swaps are noticed
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        stamp.append((entry.name, st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(stamp)
+
+
+async def show_config() -> dict:
+    # "nix config show" is the new spelling, "nix show-config" the old one
+    for command in [["config", "show"], ["show-config"]]:
+        result = await run_captured("nix", *command, "--json")
+        if result.returncode == 0:
+            return json.loads(result.stdout)
+    return {}
+
+
+async def resolve() -> NodeFacts:
+    config = await show_config()
+    system = config.get("system", {}).get("value")
+    if not system:
+        eval = await run_captured(
+            "nix", "eval", "--raw", "--impure", "--expr", "builtins.currentSystem"
+        )
+        if eval.returncode != 0:
+            raise RuntimeError(
+                f"nix eval (currentSystem) failed: {eval.returncode=} {eval.stderr=}"
+            )
+        system = eval.stdout
+    extraPlatforms = config.get("extra-platforms", {}).get("value", [])
+    substituters = [
+        *config.get("substituters", {}).get("value", []),
+        *config.get("extra-substituters", {}).get("value", []),
+    ]
+    return NodeFacts(
+        system, [p for p in extraPlatforms if p != system], substituters
+    )
+
+
+class NodeFactsCache:
+    """
+    Resolves NodeFacts once and again only when the Nix config changes.
+    The config is looked at no more than every checkInterval seconds, off
+    the event loop.
+    """
+
+    def __init__(
+        self, confDir: Path = NIX_CONF_DIR, checkInterval: float = CONF_CHECK_INTERVAL
+    ):
+        self.confDir = confDir
+        self.checkInterval = checkInterval
+        self.facts: Optional[NodeFacts] = None
+        self.stamp: Tuple = ()
+        self.checked = -math.inf
+        self.lock = asyncio.Lock()
+
+    async def refresh(self) -> NodeFacts:
+        start_time = time.perf_counter()
+        # Stamp before resolving so a change during resolve triggers another
+        stamp = await aiofs.run(conf_stamp, self.confDir)
+        self.checked = time.monotonic()
+        self.facts = await resolve()
+        self.stamp = stamp
+        logger.info(
+            f"Resolved {self.facts} in {time.perf_counter() - start_time:.3f} seconds"
+        )
+        return self.facts
+
+    def fresh(self) -> bool:
+        return time.monotonic() - self.checked < self.checkInterval
+
+    async def get(self) -> NodeFacts:
+        if self.facts is not None and self.fresh():
+            return self.facts
+        async with self.lock:
+            if self.facts is None:
+                return await self.refresh()
+            if self.fresh():
+                return self.facts
+            stamp = await aiofs.run(conf_stamp, self.confDir)
+            self.checked = time.monotonic()
+            if stamp != self.stamp:
+                return await self.refresh()
+            return self.facts
+
+
+NODE_FACTS = NodeFactsCache()
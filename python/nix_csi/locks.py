@@ -0,0 +1,64 @@
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class KeyedLockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class KeyedLock:
+    """
+    One asyncio.Lock per key. Entries only live while someone holds or waits
+    for them so the table doesn't grow with every key ever seen.
+    """
+
+    def __init__(self):
+        self.entries: Dict[Hashable, KeyedLockEntry] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = KeyedLockEntry()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self.entries[key]
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution. The
+    first caller starts the work, everyone calling with the same key before
+    it finishes gets the same result or exception.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        # Shielded so a cancelled caller doesn't cancel the work for others
+        return await asyncio.shield(future)
@@ -0,0 +1,209 @@
+import asyncio
+import errno
+import functools
+import logging
+import os
+import shutil
+import stat
+import threading
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+# Linking is syscall bound, threads release the GIL while the kernel works
+MATERIALIZE_POOL = ThreadPoolExecutor(
+    max_workers=min(32, (os.cpu_count() or 1) * 4),
+    thread_name_prefix="materialize",
+)
+
+# Roughly how much memory templates may take. A nixpkgs toolchain closure
+# is a few hundred thousand entries, ~30 MiB of templates.
+TEMPLATE_CACHE_BYTES = int(os.environ.get("NIX_CSI_TEMPLATE_CACHE_MIB", 64)) << 20
+
+
+def link_file(src: str, dst: str):
+    """Hardlink src to dst, copy if we can't link across or more times"""
+    try:
+        os.link(src, dst, follow_symlinks=False)
+    except OSError as ex:
+        if ex.errno not in (errno.EXDEV, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst, follow_symlinks=False)
+
+
+class Template(NamedTuple):
+    """
+    Skeleton of a store path. Paths are relative to the store path, "" is
+    the store path itself. Directories are ordered parents first.
+    """
+
+    dirs: List[Tuple[str, int]]
+    files: List[str]
+    symlinks: List[Tuple[str, str]]
+
+    def __len__(self):
+        return len(self.dirs) + len(self.files) + len(self.symlinks)
+
+    def weight(self) -> int:
+        """Approximate size in memory: list slots, tuples, str and int objects"""
+        return (
+            sum(141 + len(relPath) for relPath, _ in self.dirs)
+            + sum(57 + len(relPath) for relPath in self.files)
+            + sum(162 + len(relPath) + len(target) for relPath, target in self.symlinks)
+        )
+
+
+def scan_tree(src: str) -> Template:
+    """
+    Walk src once and record its skeleton. Like rsync --one-file-system we
+    don't descend into mount points, they're recorded as empty directories.
+    """
+    template = Template([], [], [])
+    st = os.lstat(src)
+    if stat.S_ISLNK(st.st_mode):
+        template.symlinks.append(("", os.readlink(src)))
+        return template
+    if not stat.S_ISDIR(st.st_mode):
+        template.files.append("")
+        return template
+
+    template.dirs.append(("", stat.S_IMODE(st.st_mode)))
+    stack = [(src, "")]
+    while stack:
+        srcDir, relDir = stack.pop()
+        with os.scandir(srcDir) as entries:
+            for entry in entries:
+                relPath = os.path.join(relDir, entry.name)
+                if entry.is_symlink():
+                    template.symlinks.append((relPath, os.readlink(entry.path)))
+                elif entry.is_dir(follow_symlinks=False):
+                    entryStat = entry.stat(follow_symlinks=False)
+                    template.dirs.append((relPath, stat.S_IMODE(entryStat.st_mode)))
+                    if entryStat.st_dev == st.st_dev:
+                        stack.append((entry.path, relPath))
+                elif entry.is_file(follow_symlinks=False):
+                    template.files.append(relPath)
+    return template
+
+
+def join(base: str, relPath: str) -> str:
+    # os.path.join adds a trailing slash for "", which breaks files
+    return os.path.join(base, relPath) if relPath else base
+
+
+def replay_tree(template: Template, src: str, dst: str):
+    """Recreate a scanned store path at dst, without reading any directories"""
+    for relPath, _ in template.dirs:
+        os.mkdir(join(dst, relPath))
+    for relPath in template.files:
+        link_file(join(src, relPath), join(dst, relPath))
+    for relPath, target in template.symlinks:
+        os.symlink(target, join(dst, relPath))
+    # Store paths are readonly, apply directory modes after populating
+    for relPath, mode in reversed(template.dirs):
+        os.chmod(join(dst, relPath), mode)
+
+
+class TemplateCache:
+    """
+    Skeletons of store paths, so each is only walked once while it's
+    cached. The least recently used are evicted once over maxBytes.
+    """
+
+    def __init__(self, maxBytes: int = TEMPLATE_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.templates: OrderedDict[str, Template] = OrderedDict()
+        self.weights: Dict[str, int] = {}
+        self.scans: Dict[str, Future] = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, storePath: str) -> Template:
+        with self.lock:
+            template = self.templates.get(storePath)
+            metrics.cache_lookup("template", template is not None)
+            if template is not None:
+                self.templates.move_to_end(storePath)
+                return template
+            # Only one thread scans a given path, the others wait for it
+            scan = self.scans.get(storePath)
+            if scan is not None:
+                leader = False
+            else:
+                leader = True
+                scan = self.scans[storePath] = Future()
+        if not leader:
+            return scan.result()
+
+        # Scan without holding the lock
+        try:
+            template = scan_tree(storePath)
+        except BaseException as ex:
+            with self.lock:
+                del self.scans[storePath]
+            scan.set_exception(ex)
+            raise
+        weight = template.weight()
+        with self.lock:
+            del self.scans[storePath]
+            self.templates[storePath] = template
+            self.weights[storePath] = weight
+            self.bytes += weight
+            self.evict()
+        scan.set_result(template)
+        return template
+
+    def evict(self):
+        # Caller holds the lock, the template just added may go too
+        while self.bytes > self.maxBytes and self.templates:
+            storePath, _ = self.templates.popitem(last=False)
+            self.bytes -= self.weights.pop(storePath)
+
+
+TEMPLATES = TemplateCache()
+
+
+def materialize_path(storePath: str, storeDir: Path) -> bool:
+    """Link one store path into storeDir, returns False if it already exists"""
+    name = os.path.basename(storePath)
+    dst = storeDir / name
+    if os.path.lexists(dst):
+        return False
+
+    template = TEMPLATES.get(storePath)
+    # Build next to the destination and rename so a present path is complete
+    tmp = storeDir / f".{name}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        replay_tree(template, storePath, str(tmp))
+        os.rename(tmp, dst)
+    except OSError as ex:
+        if tmp.is_dir() and not tmp.is_symlink():
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            tmp.unlink(missing_ok=True)
+        # Someone else won the race, that's fine since store paths are immutable
+        if ex.errno in (errno.EEXIST, errno.ENOTEMPTY) and os.path.lexists(dst):
+            return False
+        raise
+    return True
+
+
+async def materialize(paths: Iterable[str], storeDir: Path) -> int:
+    """Hardlink the store paths into storeDir in parallel, returns new path count"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        MATERIALIZE_POOL, functools.partial(storeDir.mkdir, parents=True, exist_ok=True)
+    )
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(MATERIALIZE_POOL, materialize_path, path, storeDir)
+            for path in paths
+        ]
+    )
+    return sum(results)
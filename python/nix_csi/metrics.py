@@ -0,0 +1,90 @@
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger("nix-csi")
+
+# Publishes range from milliseconds (everything cached) to many minutes (builds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+PUBLISH_SECONDS = Histogram(
+    "nix_csi_publish_seconds",
+    "NodePublishVolume duration",
+    buckets=BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "nix_csi_stage_seconds",
+    "Time spent in a publish stage, after getting a slot",
+    ["stage"],
+    buckets=BUCKETS,
+)
+STAGE_WAIT_SECONDS = Histogram(
+    "nix_csi_stage_wait_seconds",
+    "Time spent waiting for a slot in a publish stage",
+    ["stage", "priority"],
+    buckets=BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "nix_csi_cache_lookups_total",
+    "Cache lookups by cache and result",
+    ["cache", "result"],
+)
+SUBPROCESS_SECONDS = Histogram(
+    "nix_csi_subprocess_seconds",
+    "Subprocess duration by command",
+    ["command"],
+    buckets=BUCKETS,
+)
+SUBPROCESS_FAILURES = Counter(
+    "nix_csi_subprocess_failures_total",
+    "Subprocesses exiting non-zero by command",
+    ["command"],
+)
+DAEMON_SECONDS = Histogram(
+    "nix_csi_daemon_op_seconds",
+    "nix-daemon operation duration by operation",
+    ["op"],
+    buckets=BUCKETS,
+)
+EVALUATORS_RETIRED = Counter(
+    "nix_csi_evaluators_retired_total",
+    "Evaluator processes replaced, by reason",
+    ["reason"],
+)
+PREFETCHES = Counter(
+    "nix_csi_prefetches_total",
+    "Volumes of Pods bound to this node prepared ahead of publish, by result",
+    ["result"],
+)
+UPLOAD_QUEUE = Gauge(
+    "nix_csi_upload_queue_roots",
+    "Roots waiting for the next cache upload batch",
+)
+UPLOAD_INFLIGHT = Gauge(
+    "nix_csi_upload_inflight_batches",
+    "Cache upload batches uploading or backing off",
+)
+UPLOADED_PATHS = Counter(
+    "nix_csi_uploaded_paths_total",
+    "Store paths copied to the cache",
+)
+JOB_SECONDS = Histogram(
+    "nix_csi_build_job_seconds",
+    "Build Job duration from creation or lookup until finished",
+    ["result"],
+    buckets=BUCKETS,
+)
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def command_name(args) -> str:
+    # "nix build", "nix copy", keeps label cardinality low
+    return " ".join(str(arg) for arg in args[:2] if not str(arg).startswith("-"))
+
+
+def start(port: int):
+    start_http_server(port)
+    logger.info(f"Serving metrics on :{port}/metrics")
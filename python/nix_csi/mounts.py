@@ -0,0 +1,157 @@
+import ctypes
+import errno
+import logging
+import os
+import re
+import select
+import threading
+
+from pathlib import Path
+from typing import Optional, Set
+from . import aiofs
+
+logger = logging.getLogger("nix-csi")
+
+MOUNTINFO = Path("/proc/self/mountinfo")
+
+# From linux/mount.h
+MS_RDONLY = 1
+MS_REMOUNT = 32
+MS_BIND = 4096
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mount.argtypes = [
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_ulong,
+    ctypes.c_char_p,
+]
+libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+
+def encode(value: Optional[os.PathLike | str]) -> Optional[bytes]:
+    return None if value is None else os.fsencode(value)
+
+
+def sys_mount(
+    source: Optional[os.PathLike | str],
+    target: os.PathLike | str,
+    fstype: Optional[str],
+    flags: int,
+    data: Optional[str] = None,
+):
+    if libc.mount(encode(source), encode(target), encode(fstype), flags, encode(data)):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(target))
+
+
+def sys_umount(target: os.PathLike | str, flags: int = 0):
+    if libc.umount2(encode(target), flags):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(target))
+
+
+def unescape(field: str) -> str:
+    # mountinfo escapes space, tab, newline and backslash as octal
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text: str) -> Set[str]:
+    return {unescape(line.split(" ", 5)[4]) for line in text.splitlines() if line}
+
+
+class MountTable:
+    """
+    Mount points of our mount namespace. The kernel flags mountinfo with
+    POLLPRI whenever the table changes, we only reparse it then so lookups
+    are a set membership test in the common case.
+    """
+
+    def __init__(self, mountinfo: Path = MOUNTINFO):
+        self.mountinfo = mountinfo
+        self.file = None
+        self.poller = select.poll()
+        self.points: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        # Caller holds the lock
+        if self.file is None:
+            self.file = open(self.mountinfo)
+            self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        elif not self.poller.poll(0):
+            return
+        # Reading from the start acknowledges the change
+        self.file.seek(0)
+        self.points = parse_mountinfo(self.file.read())
+
+    def __contains__(self, path: os.PathLike | str) -> bool:
+        with self.lock:
+            self.refresh()
+            return os.path.realpath(path) in self.points
+
+
+MOUNTS = MountTable()
+
+
+def mounted(path: Path) -> bool:
+    """Like mountpoint --quiet, without spawning it"""
+    return path in MOUNTS
+
+
+def bind_readonly(source: Path, target: Path):
+    if mounted(target):
+        logger.debug(f"Mount target {target} was already mounted")
+        return
+    sys_mount(source, target, None, MS_BIND)
+    try:
+        # Bind mounts ignore MS_RDONLY until remounted
+        sys_mount(None, target, None, MS_REMOUNT | MS_BIND | MS_RDONLY)
+    except OSError:
+        sys_umount(target)
+        raise
+
+
+def overlay(lowerdir: Path, upperdir: Path, workdir: Path, target: Path):
+    if mounted(target):
+        logger.debug(f"Mount target {target} was already mounted")
+        return
+    sys_mount(
+        "overlay",
+        target,
+        "overlay",
+        0,
+        f"lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}",
+    )
+
+
+def unmount(target: Path) -> bool:
+    """Unmount target, returns False if it wasn't mounted"""
+    try:
+        sys_umount(target)
+    except OSError as ex:
+        # Unpublish has to be idempotent, a target that's gone or was
+        # never created isn't mounted either
+        if ex.errno == errno.ENOENT:
+            return False
+        if ex.errno == errno.EINVAL and not mounted(target):
+            return False
+        raise
+    return True
+
+
+async def is_mounted(path: Path) -> bool:
+    return await aiofs.run(mounted, path)
+
+
+async def mount_bind_readonly(source: Path, target: Path):
+    await aiofs.run(bind_readonly, source, target)
+
+
+async def mount_overlay(lowerdir: Path, upperdir: Path, workdir: Path, target: Path):
+    await aiofs.run(overlay, lowerdir, upperdir, workdir, target)
+
+
+async def umount(target: Path) -> bool:
+    return await aiofs.run(unmount, target)
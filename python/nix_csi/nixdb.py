@@ -0,0 +1,245 @@
+import asyncio
+import fcntl
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Optional
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+# The CSI pods Nix state, this is the database we copy path registrations from
+HOST_STATE_DIR = Path(os.environ.get("NIX_CSI_HOST_STATE_DIR", "/nix/var/nix"))
+# Files next to db.sqlite that tell Nix which schema it's looking at
+SCHEMA_FILES = ["schema", "ca-schema"]
+# Files making up a finished database
+DB_FILES = ["db.sqlite", *SCHEMA_FILES]
+# ioctl to share extents between files on btrfs, xfs and friends
+FICLONE = 0x40049409
+
+
+class NixDbError(Exception):
+    pass
+
+
+def connect_host(hostStateDir: Path = HOST_STATE_DIR, **kwargs) -> sqlite3.Connection:
+    """Readonly connection to the hosts Nix database"""
+    return sqlite3.connect(
+        f"{(hostStateDir / 'db/db.sqlite').as_uri()}?mode=ro",
+        uri=True,
+        **kwargs,
+    )
+
+
+def create_template(templateDir: Path, hostStateDir: Path = HOST_STATE_DIR):
+    """
+    Create an empty Nix database with the same schema as the hosts, volume
+    databases start out as a copy of this.
+    """
+    templateDir.mkdir(parents=True, exist_ok=True)
+    tmp = templateDir / "db.sqlite.tmp"
+    tmp.unlink(missing_ok=True)
+    with closing(connect_host(hostStateDir)) as host, closing(
+        sqlite3.connect(tmp)
+    ) as db:
+        schema = host.execute(
+            "SELECT sql FROM sqlite_master"
+            " WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+            " ORDER BY rowid"
+        ).fetchall()
+        with db:
+            for (sql,) in schema:
+                db.execute(sql)
+    os.replace(tmp, templateDir / "db.sqlite")
+    for name in SCHEMA_FILES:
+        if (hostStateDir / "db" / name).exists():
+            shutil.copyfile(hostStateDir / "db" / name, templateDir / name)
+
+
+def write_db(
+    stateDir: Path,
+    paths: Iterable[str],
+    templateDir: Path,
+    hostStateDir: Path = HOST_STATE_DIR,
+):
+    """
+    Register paths in a new Nix database under stateDir. Rows are copied the
+    way nix-store --dump-db | nix-store --load-db would: hash, narSize,
+    deriver and references are kept, registrationTime is now and signatures,
+    content addresses and ultimate trust are dropped.
+    """
+    paths = set(paths)
+    dbDir = stateDir / "db"
+    dbDir.mkdir(parents=True, exist_ok=True)
+    for name in ["gcroots", "profiles", "temproots"]:
+        (stateDir / name).mkdir(exist_ok=True)
+    for name in DB_FILES:
+        if (templateDir / name).exists():
+            clone_file(templateDir / name, dbDir / name)
+
+    with closing(
+        sqlite3.connect((dbDir / "db.sqlite").as_uri(), uri=True, isolation_level=None)
+    ) as db:
+        db.execute(
+            "ATTACH DATABASE ? AS host",
+            (f"{(hostStateDir / 'db/db.sqlite').as_uri()}?mode=ro",),
+        )
+        db.execute("CREATE TEMP TABLE Wanted (path TEXT PRIMARY KEY NOT NULL)")
+        db.executemany(
+            "INSERT INTO temp.Wanted (path) VALUES (?)", ((p,) for p in paths)
+        )
+
+        db.execute("BEGIN")
+        try:
+            inserted = db.execute(
+                "INSERT INTO main.ValidPaths (path, hash, registrationTime, deriver, narSize)"
+                " SELECT v.path, v.hash, ?, v.deriver, v.narSize"
+                " FROM temp.Wanted w JOIN host.ValidPaths v ON v.path = w.path",
+                (int(time.time()),),
+            ).rowcount
+            if inserted != len(paths):
+                raise NixDbError(
+                    f"{len(paths) - inserted} of {len(paths)} paths aren't valid on the host"
+                )
+            db.execute(
+                "INSERT INTO main.Refs (referrer, reference)"
+                " SELECT referrer.id, reference.id"
+                " FROM main.ValidPaths referrer"
+                " JOIN host.ValidPaths hostReferrer ON hostReferrer.path = referrer.path"
+                " JOIN host.Refs r ON r.referrer = hostReferrer.id"
+                " JOIN host.ValidPaths hostReference ON hostReference.id = r.reference"
+                " JOIN main.ValidPaths reference ON reference.path = hostReference.path"
+            )
+            # load-db parses registered derivations and records their outputs
+            db.execute(
+                "INSERT INTO main.DerivationOutputs (drv, id, path)"
+                " SELECT drv.id, o.id, o.path"
+                " FROM main.ValidPaths drv"
+                " JOIN host.ValidPaths hostDrv ON hostDrv.path = drv.path"
+                " JOIN host.DerivationOutputs o ON o.drv = hostDrv.id"
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("DETACH DATABASE host")
+
+
+def clone_file(src: Path, dst: Path):
+    """Reflink src to dst where the filesystem supports it, copy otherwise"""
+    with open(src, "rb") as srcFile, open(dst, "wb") as dstFile:
+        try:
+            fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+class SnapshotCache:
+    """
+    Finished volume databases keyed by root store path. A closure never
+    changes so the database for a root is the same for every volume, the
+    least recently used snapshots are evicted once over maxBytes.
+    """
+
+    def __init__(self, cacheDir: Path, maxBytes: int = 512 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.sizes: OrderedDict[str, int] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Index snapshots left over from previous runs, oldest first"""
+        self.cacheDir.mkdir(parents=True, exist_ok=True)
+        snapshots = []
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.startswith("."):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            files = [Path(entry.path) / name for name in DB_FILES]
+            size = sum(f.stat().st_size for f in files if f.exists())
+            snapshots.append((entry.stat().st_mtime, entry.name, size))
+        with self.lock:
+            for _, name, size in sorted(snapshots):
+                self.sizes[name] = size
+            self.evict()
+
+    def restore(self, root: str, stateDir: Path) -> bool:
+        name = os.path.basename(root)
+        with self.lock:
+            metrics.cache_lookup("db-snapshot", name in self.sizes)
+            if name not in self.sizes:
+                return False
+            self.sizes.move_to_end(name)
+            snapshot = self.cacheDir / name
+            (stateDir / "db").mkdir(parents=True, exist_ok=True)
+            for fileName in DB_FILES:
+                if (snapshot / fileName).exists():
+                    clone_file(snapshot / fileName, stateDir / "db" / fileName)
+            os.utime(snapshot)
+        for dirName in ["gcroots", "profiles", "temproots"]:
+            (stateDir / dirName).mkdir(exist_ok=True)
+        return True
+
+    def store(self, root: str, stateDir: Path):
+        name = os.path.basename(root)
+        # Copy outside the lock and rename into place
+        tmp = self.cacheDir / f".{name}.{uuid.uuid4().hex[:8]}"
+        tmp.mkdir(parents=True)
+        size = 0
+        for fileName in DB_FILES:
+            if (stateDir / "db" / fileName).exists():
+                clone_file(stateDir / "db" / fileName, tmp / fileName)
+                size += (tmp / fileName).stat().st_size
+        with self.lock:
+            if name in self.sizes:
+                shutil.rmtree(tmp, ignore_errors=True)
+                return
+            os.rename(tmp, self.cacheDir / name)
+            self.sizes[name] = size
+            self.evict()
+
+    def evict(self):
+        # Caller holds the lock
+        while self.sizes and sum(self.sizes.values()) > self.maxBytes:
+            name, _ = self.sizes.popitem(last=False)
+            shutil.rmtree(self.cacheDir / name, ignore_errors=True)
+
+
+def build_db(
+    stateDir: Path,
+    paths: Iterable[str],
+    templateDir: Path,
+    snapshots: Optional[SnapshotCache] = None,
+    root: Optional[str] = None,
+):
+    """Restore the database for root from snapshots, or write and snapshot it"""
+    if snapshots is not None and root is not None:
+        if snapshots.restore(root, stateDir):
+            logger.debug(f"Database for {root} from snapshot")
+            return
+    write_db(stateDir, paths, templateDir)
+    if snapshots is not None and root is not None:
+        snapshots.store(root, stateDir)
+
+
+async def init_db(
+    stateDir: Path,
+    paths: Iterable[str],
+    templateDir: Path,
+    snapshots: Optional[SnapshotCache] = None,
+    root: Optional[str] = None,
+):
+    """Create the volume database on a worker thread"""
+    await asyncio.to_thread(
+        build_db, stateDir, list(paths), templateDir, snapshots, root
+    )
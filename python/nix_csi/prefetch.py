@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, cast
+from cachetools import TTLCache
+from kr8s.asyncio.objects import Pod
+
+import kr8s
+
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+KUBE_NODE_NAME = os.environ.get("KUBE_NODE_NAME", "shitbox")
+DRIVER_NAME = "nix.csi.store"
+
+Prepare = Callable[[str, Dict[str, str]], Awaitable[None]]
+Release = Callable[[str], Awaitable[None]]
+
+
+def inline_volumes(pod: Pod) -> List[Tuple[str, Dict[str, str]]]:
+    """Names and attributes of the nix-csi inline volumes of a Pod"""
+    volumes = []
+    for volume in pod.raw.get("spec", {}).get("volumes", []):
+        csi = volume.get("csi") or {}
+        if csi.get("driver") == DRIVER_NAME:
+            volumes.append((volume["name"], dict(csi.get("volumeAttributes") or {})))
+    return volumes
+
+
+class Prefetcher:
+    """
+    Watches Pods bound to this node and prepares their nix-csi volumes
+    before kubelet gets around to NodePublishVolume. A few workers take
+    volumes off a bounded queue, volumes that don't fit are left for the
+    publish. Whatever a prefetch prepared is held for holdSeconds, long
+    enough for the publish to take its own reference.
+    """
+
+    def __init__(self, workers: int = 2, maxQueued: int = 64, holdSeconds: float = 600):
+        self.workers = workers
+        self.holdSeconds = holdSeconds
+        self.queue: asyncio.Queue[Tuple[str, Dict[str, str]]] = asyncio.Queue(maxQueued)
+        # Volumes we've queued, so watch events for the same Pod don't requeue
+        self.seen: TTLCache[str, None] = TTLCache(4096, 3600)
+        self.tasks: List[asyncio.Task] = []
+        self.holds: Set[asyncio.Task] = set()
+        self.prepare: Optional[Prepare] = None
+        self.release: Optional[Release] = None
+
+    def start(self, prepare: Prepare, release: Release):
+        self.prepare = prepare
+        self.release = release
+        self.tasks.append(asyncio.create_task(self.watch()))
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.work()))
+
+    def offer(self, pod: Pod):
+        metadata = pod.raw.get("metadata", {})
+        # Running Pods have their volumes, deleted ones won't need them
+        if pod.raw.get("status", {}).get("phase") != "Pending":
+            return
+        if metadata.get("deletionTimestamp"):
+            return
+        for name, attributes in inline_volumes(pod):
+            key = f"{metadata.get('uid')}-{name}"
+            if key in self.seen:
+                continue
+            try:
+                self.queue.put_nowait((key, attributes))
+            except asyncio.QueueFull:
+                metrics.PREFETCHES.labels("dropped").inc()
+                logger.debug(f"Prefetch queue full, leaving {pod.name}/{name} to publish")
+                return
+            self.seen[key] = None
+
+    async def watch(self):
+        selector = {"spec.nodeName": KUBE_NODE_NAME}
+        while True:
+            try:
+                async for pod in kr8s.asyncio.get(
+                    "pods", namespace=kr8s.ALL, field_selector=selector
+                ):
+                    self.offer(cast(Pod, pod))
+                async for event, pod in kr8s.asyncio.watch(
+                    "pods", namespace=kr8s.ALL, field_selector=selector
+                ):
+                    if event != "DELETED":
+                        self.offer(cast(Pod, pod))
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.warning(f"Pod watch failed, restarting: {ex}")
+                await asyncio.sleep(5)
+
+    async def work(self):
+        assert self.prepare is not None
+        while True:
+            key, attributes = await self.queue.get()
+            try:
+                await self.prepare(key, attributes)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # The publish will fail the same way, with someone to tell
+                metrics.PREFETCHES.labels("failed").inc()
+                logger.info(f"Prefetching {key} failed: {ex}")
+            else:
+                metrics.PREFETCHES.labels("prepared").inc()
+                hold = asyncio.create_task(self.hold(key))
+                self.holds.add(hold)
+                hold.add_done_callback(self.holds.discard)
+
+    async def hold(self, key: str):
+        assert self.release is not None
+        await asyncio.sleep(self.holdSeconds)
+        try:
+            await self.release(key)
+        except Exception as ex:
+            logger.warning(f"Releasing prefetched {key} failed: {ex}")
+
+    def stop(self):
+        for task in [*self.tasks, *self.holds]:
+            task.cancel()
+
+
+PREFETCHER = Prefetcher()
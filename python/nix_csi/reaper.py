@@ -0,0 +1,127 @@
+import asyncio
+import ctypes
+import errno
+import logging
+import os
+import platform
+import shutil
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+from . import aiofs
+
+logger = logging.getLogger("nix-csi")
+
+# ioprio_set(2) has no libc wrapper
+IOPRIO_SET = {"x86_64": 251, "aarch64": 30}.get(platform.machine())
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def set_idle_io_priority():
+    """
+    Only get disk time when nobody else wants it. With IOPRIO_WHO_PROCESS
+    and 0 this applies to the calling thread, not the whole driver.
+    """
+    if IOPRIO_SET is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(
+        IOPRIO_SET, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    ):
+        logger.debug(f"ioprio_set failed: {os.strerror(ctypes.get_errno())}")
+
+
+def delete_batch(paths: List[Path]) -> int:
+    """Remove trashed trees, returns how many we removed"""
+    removed = 0
+    for path in paths:
+        try:
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+            removed += 1
+        except OSError as ex:
+            logger.error(f"Failed to remove {path}: {ex}")
+    return removed
+
+
+class Reaper:
+    """
+    Deletes trees in the background. Callers rename what they want gone into
+    trashDir, which is instant and on the same filesystem, and the reaper
+    removes it in batches on low I/O priority threads. The backlog is
+    bounded, callers wait for room once it's full.
+    """
+
+    def __init__(
+        self,
+        trashDir: Path,
+        maxBacklog: int = 256,
+        batchSize: int = 16,
+        workers: int = 2,
+    ):
+        self.trashDir = trashDir
+        self.batchSize = batchSize
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="reaper",
+            initializer=set_idle_io_priority,
+        )
+        self.queue: asyncio.Queue[Path] = asyncio.Queue(maxBacklog)
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        """Start deleting, beginning with whatever previous runs left behind"""
+        await aiofs.mkdir(self.trashDir)
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.run()))
+        for name in await aiofs.run(os.listdir, self.trashDir):
+            await self.queue.put(self.trashDir / name)
+
+    def trash(self, path: Path) -> Optional[Path]:
+        """Rename path into the trash, returns None if there was nothing"""
+        trashPath = self.trashDir / f"{path.name}.{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(path, trashPath)
+        except FileNotFoundError:
+            return None
+        return trashPath
+
+    async def discard(self, path: Path):
+        """Make path disappear now and delete it later"""
+        try:
+            trashPath = await aiofs.run(self.trash, path)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            # Not on our filesystem, no way around deleting it in place
+            await asyncio.to_thread(delete_batch, [path])
+            return
+        if trashPath is not None:
+            await self.queue.put(trashPath)
+
+    def backlog(self) -> int:
+        return self.queue.qsize()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batchSize and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                removed = await loop.run_in_executor(self.pool, delete_batch, batch)
+                logger.debug(f"Reaped {removed} trees, {self.backlog()} waiting")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def join(self):
+        """Wait for everything trashed so far to be deleted"""
+        await self.queue.join()
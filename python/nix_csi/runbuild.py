@@ -1,32 +1,137 @@
 #! /usr/bin/env python3
 
+import asyncio
+import logging
 import os
+import time
 import kr8s
-from typing import cast
+from collections import deque
+from typing import Dict, List, Optional, cast
 from kr8s.asyncio.objects import Pod, Job, ConfigMap
+from . import metrics, scheduler
+
+logger = logging.getLogger("nix-csi")
 
 NAMESPACE = os.environ.get("KUBE_NAMESPACE", "default")
 KUBE_NODE_NAME = os.environ.get("KUBE_NODE_NAME", "shitbox")
+# Every build Job carries this label, it's what the shared watch selects on
+BUILD_LABEL = "nix.csi/build"
+# Lines of build log kept per Job, from the end
+LOG_TAIL_LINES = 1000
+
+
+def finished(job: Job) -> bool:
+    conditions = job.raw.get("status", {}).get("conditions", [])
+    return any(
+        c.get("type") in ["Complete", "Failed"] and c.get("status") == "True"
+        for c in conditions
+    )
+
+
+class JobWatcher:
+    """
+    One watch on build Jobs for the whole driver, rather than one per build.
+    Builds wait on a future per Job name that is resolved when the watch
+    sees the Job finish. The watch is restarted if it drops, relisting
+    first so completions in between aren't missed.
+    """
+
+    def __init__(self):
+        self.waiters: Dict[str, List[asyncio.Future]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def resolve(self, job: Job):
+        if not finished(job):
+            return
+        for future in self.waiters.pop(job.name, []):
+            if not future.done():
+                future.set_result(job)
+
+    async def run(self):
+        selector = {BUILD_LABEL: "true"}
+        while True:
+            try:
+                async for job in kr8s.asyncio.get(
+                    "jobs", namespace=NAMESPACE, label_selector=selector
+                ):
+                    self.resolve(cast(Job, job))
+                async for _, job in kr8s.asyncio.watch(
+                    "jobs", namespace=NAMESPACE, label_selector=selector
+                ):
+                    self.resolve(cast(Job, job))
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.warning(f"Job watch failed, restarting: {ex}")
+                await asyncio.sleep(5)
+
+    async def wait(self, job: Job) -> Job:
+        labels = job.raw.get("metadata", {}).get("labels", {})
+        if self.task is None or BUILD_LABEL not in labels:
+            # Not serving, or a Job from before builds were labelled
+            await job.wait(["condition=Complete", "condition=Failed"])
+            return job
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job.name, []).append(future)
+        try:
+            # It may have finished before we started waiting
+            await job.refresh()
+            self.resolve(job)
+            return await future
+        finally:
+            waiters = self.waiters.get(job.name, [])
+            if future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self.waiters[job.name]
+
+
+WATCHER = JobWatcher()
 
 
 async def run(storePath: str, expression: str):
     jobName = f"build-{os.path.basename(storePath)[:32]}"
+    start_time = time.perf_counter()
     job: Job | None = None
 
     try:
         job = await Job.get(jobName, NAMESPACE)
     except kr8s.NotFoundError:
+        # Prefer the node that already has most of what the build needs,
+        # weighted by how much of it that is
+        closurePreference = []
+        best = await scheduler.SUMMARY.best_node(storePath)
+        if best is not None and best[1] > 0:
+            closurePreference.append(
+                {
+                    "weight": 1 + round(best[1] * 99),
+                    "preference": {
+                        "matchExpressions": [
+                            {
+                                "key": "kubernetes.io/hostname",
+                                "operator": "In",
+                                "values": [best[0]],
+                            },
+                        ]
+                    },
+                }
+            )
         job = await Job(
             {
                 "metadata": {
                     "name": jobName,
+                    "labels": {BUILD_LABEL: "true"},
                     "annotations": {"nix.csi/storePath": storePath},
                 },
                 "spec": {
+                    # Started once the build's ConfigMap exists
+                    "suspend": True,
                     "ttlSecondsAfterFinished": 86400,
                     "template": {
                         "spec": {
-                            "suspend": True,
                             "containers": [
                                 {
                                     "name": "build",
@@ -95,37 +200,38 @@ async def run(storePath: str, expression: str):
                                     "configMap": {"name": jobName},
                                 },
                             ],
-                        },
-                        "affinity": {
-                            "nodeAffinity": {
-                                "preferredDuringSchedulingIgnoredDuringExecution": [
-                                    # Use tagged builders if available
-                                    {
-                                        "weight": 100,
-                                        "preference": {
-                                            "matchExpressions": [
-                                                {
-                                                    "key": "nix.csi/builder",
-                                                    "operator": "Exists",
-                                                }
-                                            ]
+                            "affinity": {
+                                "nodeAffinity": {
+                                    "preferredDuringSchedulingIgnoredDuringExecution": [
+                                        # Use tagged builders if available
+                                        {
+                                            "weight": 100,
+                                            "preference": {
+                                                "matchExpressions": [
+                                                    {
+                                                        "key": "nix.csi/builder",
+                                                        "operator": "Exists",
+                                                    }
+                                                ]
+                                            },
                                         },
-                                    },
-                                    # Use same host that requested the build if available
-                                    {
-                                        "weight": 50,
-                                        "preference": {
-                                            "matchExpressions": [
-                                                {
-                                                    "key": "kubernetes.io/hostname",
-                                                    "operator": "In",
-                                                    "values": [KUBE_NODE_NAME],
-                                                },
-                                            ]
+                                        # Use same host that requested the build if available
+                                        {
+                                            "weight": 50,
+                                            "preference": {
+                                                "matchExpressions": [
+                                                    {
+                                                        "key": "kubernetes.io/hostname",
+                                                        "operator": "In",
+                                                        "values": [KUBE_NODE_NAME],
+                                                    },
+                                                ]
+                                            },
                                         },
-                                    },
-                                ]
-                            }
+                                        *closurePreference,
+                                    ]
+                                }
+                            },
                         },
                     },
                     "backoffLimit": 1,  # amount of restarts allowed
@@ -149,10 +255,15 @@ async def run(storePath: str, expression: str):
         await cm.set_owner(job)
         await job.patch({"spec": {"suspend": False}})
 
-    await job.wait(["condition=Complete", "condition=Failed"])
+    job = await WATCHER.wait(job)
 
     success = job.status.get("succeeded", 0) == 1
-    log = ""
+    metrics.JOB_SECONDS.labels("succeeded" if success else "failed").observe(
+        time.perf_counter() - start_time
+    )
+    # Only the end of a build log is interesting. The API server caps each
+    # pod's log, the deque the total over retried pods
+    tail: deque[str] = deque(maxlen=LOG_TAIL_LINES)
 
     async for pod in kr8s.asyncio.get(
         "pods",
@@ -160,8 +271,10 @@ async def run(storePath: str, expression: str):
         label_selector={"batch.kubernetes.io/job-name": jobName},
     ):
         pod = cast(Pod, pod)
-        log += f"{pod.name=}\n"
-        log += "\n".join([line async for line in pod.logs()])
+        tail.append(f"{pod.name=}")
+        async for line in pod.logs(tail_lines=LOG_TAIL_LINES):
+            tail.append(line)
+    log = "\n".join(tail)
 
     if success:
         await job.delete(propagation_policy="Foreground")
@@ -0,0 +1,210 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, cast
+from kr8s.asyncio.objects import ConfigMap
+
+import kr8s
+
+from . import closure
+
+logger = logging.getLogger("nix-csi")
+
+NAMESPACE = os.environ.get("KUBE_NAMESPACE", "default")
+KUBE_NODE_NAME = os.environ.get("KUBE_NODE_NAME", "shitbox")
+# Every node summary ConfigMap carries this label
+SUMMARY_LABEL = "nix.csi/store-summary"
+# Comfortably below the 1MiB ConfigMap limit once base64 encoded
+MAX_FILTER_BYTES = 512 * 1024
+FALSE_POSITIVE_RATE = 0.01
+# Summaries are republished every interval, one that missed a few is from a
+# node that's gone or whose driver isn't running, and after a day nobody's
+# coming back for it
+STALE_INTERVALS = 3
+EXPIRE_SECONDS = 86400
+
+
+def hash_part(storePath: str) -> bytes:
+    return os.path.basename(storePath).split("-", 1)[0].encode()
+
+
+def hash_pair(storePath: str) -> Tuple[int, int]:
+    """The two hashes the positions of storePath are derived from, in any filter"""
+    digest = hashlib.blake2b(hash_part(storePath), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class BloomFilter:
+    """Store path summary, sized for the path count and a 1% false positive rate"""
+
+    def __init__(self, bits: int, hashes: int, data: Optional[bytes] = None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def sized(cls, entries: int) -> "BloomFilter":
+        entries = max(entries, 1)
+        bits = int(-entries * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2)
+        bits = min(max(bits, 64), MAX_FILTER_BYTES * 8)
+        hashes = min(max(round(bits / entries * math.log(2)), 1), 16)
+        return cls(bits, hashes)
+
+    def positions(self, pair: Tuple[int, int]) -> Iterable[int]:
+        # Double hashing, Kirsch and Mitzenmacher
+        h1, h2 = pair
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, storePath: str):
+        for position in self.positions(hash_pair(storePath)):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def has(self, pair: Tuple[int, int]) -> bool:
+        return all(
+            self.data[position >> 3] & (1 << (position & 7))
+            for position in self.positions(pair)
+        )
+
+    def __contains__(self, storePath: str) -> bool:
+        return self.has(hash_pair(storePath))
+
+
+def summarize(paths: List[str]) -> BloomFilter:
+    bloom = BloomFilter.sized(len(paths))
+    for path in paths:
+        bloom.add(path)
+    return bloom
+
+
+def best_summary(
+    summaries: List[Dict], inputs: List[str]
+) -> Optional[Tuple[str, float]]:
+    """Decode and score summary ConfigMaps, inputs are hashed once for all of them"""
+    pairs = [hash_pair(path) for path in inputs]
+    best: Optional[Tuple[str, float]] = None
+    for raw in summaries:
+        try:
+            bloom = BloomFilter(
+                int(raw["data"]["bits"]),
+                int(raw["data"]["hashes"]),
+                base64.b64decode(raw["binaryData"]["bloom"]),
+            )
+            node = raw["data"]["node"]
+        except (KeyError, ValueError) as ex:
+            logger.debug(
+                f"Ignoring malformed store summary {raw['metadata']['name']}: {ex}"
+            )
+            continue
+        score = sum(bloom.has(pair) for pair in pairs) / len(pairs)
+        if best is None or score > best[1]:
+            best = (node, score)
+    return best
+
+
+class StoreSummary:
+    """
+    Publishes a bloom filter of this nodes store to a ConfigMap and scores
+    nodes for builds by how much of the input closure they already have.
+    """
+
+    def __init__(self, interval: float = 300):
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await self.publish()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.warning(f"Publishing store summary failed: {ex}")
+            await asyncio.sleep(self.interval)
+
+    async def publish(self):
+        paths = await asyncio.to_thread(closure.CLOSURES.all_paths)
+        bloom = await asyncio.to_thread(summarize, paths)
+        name = f"nix-csi-summary-{KUBE_NODE_NAME}"
+        body = {
+            "data": {
+                "node": KUBE_NODE_NAME,
+                "bits": str(bloom.bits),
+                "hashes": str(bloom.hashes),
+                "published": str(int(time.time())),
+            },
+            "binaryData": {"bloom": base64.b64encode(bloom.data).decode()},
+        }
+        try:
+            cm = await ConfigMap.get(name, NAMESPACE)
+            await cm.patch(body)
+        except kr8s.NotFoundError:
+            cm = await ConfigMap(
+                {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "metadata": {"name": name, "labels": {SUMMARY_LABEL: "true"}},
+                    **body,
+                },
+                NAMESPACE,
+            )
+            await cm.create()
+        logger.debug(
+            f"Published store summary of {len(paths)} paths in {len(bloom.data)} bytes"
+        )
+
+    async def best_node(self, storePath: str) -> Optional[Tuple[str, float]]:
+        """The node holding most of the input closure of storePath and its share"""
+        try:
+            inputs = await asyncio.to_thread(
+                closure.CLOSURES.input_closure, [storePath]
+            )
+        except (closure.ClosureError, sqlite3.Error) as ex:
+            logger.debug(f"No input closure for {storePath}: {ex}")
+            return None
+        if not inputs:
+            return None
+
+        summaries = []
+        now = time.time()
+        async for cm in kr8s.asyncio.get(
+            "configmaps", namespace=NAMESPACE, label_selector={SUMMARY_LABEL: "true"}
+        ):
+            cm = cast(ConfigMap, cm)
+            try:
+                age = now - int(cm.raw["data"]["published"])
+            except (KeyError, ValueError):
+                # From before summaries were timestamped
+                age = math.inf
+            if age > EXPIRE_SECONDS:
+                await self.remove(cm)
+            elif age <= self.interval * STALE_INTERVALS:
+                summaries.append(cm.raw)
+        if not summaries:
+            return None
+        # Decoding and probing a few hundred KiB per node adds up
+        best = await asyncio.to_thread(best_summary, summaries, inputs)
+        logger.debug(f"Best builder for {Path(storePath).name}: {best}")
+        return best
+
+    async def remove(self, cm: ConfigMap):
+        logger.info(f"Removing expired store summary {cm.name}")
+        try:
+            await cm.delete()
+        except kr8s.NotFoundError:
+            # Someone else got to it first
+            pass
+        except kr8s.ServerError as ex:
+            logger.warning(f"Removing store summary {cm.name} failed: {ex}")
+
+
+SUMMARY = StoreSummary()
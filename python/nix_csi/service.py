@@ -1,12 +1,10 @@
 import asyncio
 import logging
 import os
-import shlex
-import shutil
+import signal
 import socket
-import tempfile
+import sqlite3
 import time
-import math
 
 from csi import csi_grpc, csi_pb2
 from google.protobuf.wrappers_pb2 import BoolValue
@@ -15,26 +13,55 @@ from grpclib.exceptions import GRPCError
 from grpclib.server import Server
 from importlib import metadata
 from pathlib import Path
-from typing import Any, NamedTuple, Optional, List
-from cachetools import TTLCache
-from asyncio import Semaphore
-from collections import defaultdict
-from . import runbuild
+from typing import Any, List, Mapping, Optional, Tuple
+from . import (
+    aiofs,
+    cache,
+    closure,
+    daemon,
+    evaluator,
+    facts,
+    locks,
+    materialize,
+    metrics,
+    mounts,
+    nixdb,
+    prefetch,
+    reaper,
+    runbuild,
+    scheduler,
+    stages,
+    substitute,
+    uploader,
+)
+from .commands import run_captured, run_console
 
 logger = logging.getLogger("nix-csi")
 
 CSI_PLUGIN_NAME = "nix.csi.store"
 CSI_VENDOR_VERSION = metadata.version("nix-csi")
 
-MOUNT_ALREADY_MOUNTED = 32
-
 # Paths we base everything on. Remember that these are CSI pod paths not node paths.
-CSI_ROOT = Path("/nix/var/nix-csi")
+CSI_ROOT = Path(os.environ.get("NIX_CSI_ROOT", "/nix/var/nix-csi"))
 CSI_VOLUMES = CSI_ROOT / "volumes"
-CSI_GCROOTS = Path("/nix/var/nix/gcroots/nix-csi")
+# Closure and database per root store path, shared by all volumes using it
+CSI_STAGED = CSI_ROOT / "staged"
+# Links from NodeStageVolume volume ids to their staged tree
+CSI_STAGES = CSI_ROOT / "stages"
+# Links from prefetched volumes to their staged tree
+CSI_PREFETCH = CSI_ROOT / "prefetch"
+CSI_DB_TEMPLATE = CSI_ROOT / "db-template"
+CSI_DB_SNAPSHOTS = CSI_ROOT / "db-snapshots"
+CSI_CACHE_DB = CSI_ROOT / "cache.sqlite"
+# Trees waiting to be deleted, same filesystem as everything above
+CSI_TRASH = CSI_ROOT / "trash"
+CSI_GCROOTS = Path(
+    os.environ.get("NIX_CSI_GCROOTS", "/nix/var/nix/gcroots/nix-csi")
+)
 NAMESPACE = os.environ["KUBE_NAMESPACE"]
-
-RSYNC_CONCURRENCY = Semaphore(1)
+# Expressions can be impure (fetchTarball of a branch and friends), so their
+# evaluations are only trusted for this long
+EXPRESSION_TTL = int(os.environ.get("NIX_CSI_EXPRESSION_TTL", 3600))
 
 
 class NixCsiError(GRPCError):
@@ -59,91 +86,31 @@ def get_kernel_boot_time(stat_file: Path = Path("/proc/stat")) -> int:
     raise RuntimeError("btime not found in /hoststat")
 
 
-def reboot_cleanup():
+REAPER = reaper.Reaper(CSI_TRASH)
+
+
+async def reboot_cleanup():
     """Cleanup volume trees and gcroots if we have rebooted"""
     stat_file = Path("/proc/stat")
     state_file = CSI_ROOT / "proc_stat"
 
     needs_cleanup = False
-    if state_file.exists():
+    if await aiofs.exists(state_file):
         try:
-            old_boot = get_kernel_boot_time(state_file)
-            current_boot = get_kernel_boot_time(stat_file)
+            old_boot = await aiofs.run(get_kernel_boot_time, state_file)
+            current_boot = await aiofs.run(get_kernel_boot_time, stat_file)
             needs_cleanup = old_boot != current_boot
         except RuntimeError:
             # Corrupted state file, treat as needing cleanup
             needs_cleanup = True
 
-    shutil.copy2(stat_file, state_file)
+    await aiofs.copy(stat_file, state_file)
 
     if needs_cleanup:
         logger.info("Reboot detected - cleaning volumes and gcroots")
-        for path in [CSI_VOLUMES, CSI_GCROOTS]:
-            if path.exists():
-                shutil.rmtree(path)
-                path.mkdir(parents=True, exist_ok=True)
-
-
-def log_command(*args, log_level: int):
-    logger.log(
-        log_level,
-        f"Running command: {shlex.join([str(arg) for arg in args])}",
-    )
-
-
-class SubprocessResult(NamedTuple):
-    returncode: int
-    stdout: str
-    stderr: str
-    combined: str
-    elapsed: float
-
-
-# Run async subprocess, capture output and returncode
-async def run_captured(*args):
-    return await run_console(*args, log_level=logging.NOTSET)
-
-
-# Run async subprocess, forward output to console and return returncode
-async def run_console(*args, log_level: int = logging.DEBUG):
-    start_time = time.perf_counter()
-    log_command(*args, log_level=log_level)
-    proc = await asyncio.create_subprocess_exec(
-        *[str(arg) for arg in args],
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-
-    stdout_data = []
-    stderr_data = []
-    combined_data = []
-
-    async def stream_output(stream, buffer):
-        async for line in stream:
-            decoded = line.decode().strip()
-            buffer.append(decoded)
-            combined_data.append(decoded)
-            logger.log(log_level, decoded)
-
-    await asyncio.gather(
-        stream_output(proc.stdout, stdout_data),
-        stream_output(proc.stderr, stderr_data),
-        proc.wait(),
-    )
-    elapsed_time = time.perf_counter() - start_time
-    if elapsed_time > 5:
-        logger.info(
-            f"Comamnd executed in {elapsed_time} seconds: {shlex.join([str(arg) for arg in args[:5]])}"
-        )
-
-    assert proc.returncode is not None
-    return SubprocessResult(
-        proc.returncode,
-        "\n".join(stdout_data).strip(),
-        "\n".join(stderr_data).strip(),
-        "\n".join(combined_data).strip(),
-        elapsed_time,
-    )
+        for path in [CSI_VOLUMES, CSI_STAGED, CSI_STAGES, CSI_PREFETCH, CSI_GCROOTS]:
+            # Deleted in the background, serve() recreates the directories
+            await REAPER.discard(path)
 
 
 def log_request(method_name: str, request: Any):
@@ -165,351 +132,475 @@ async def set_nix_path():
             Status.INVALID_ARGUMENT,
             f"nix build (NIX_PATH) failed: {build.returncode=}",
         )
-    os.environ["NIX_PATH"] = NIX_PATH_PATH.read_text().strip()
+    os.environ["NIX_PATH"] = (await aiofs.read_text(NIX_PATH_PATH)).strip()
 
 
 class NodeServicer(csi_grpc.NodeBase):
-    # If you get evictions from cache size you are elite
-    packagePathCache: TTLCache[str, Path] = TTLCache(1337, 60)
-    pathInfoCache: TTLCache[Path, List[str]] = TTLCache(1337, 60)
-    copyPathsCache: TTLCache[str, None] = TTLCache(math.inf, 60)
-    expressionLock: defaultdict[str, Semaphore] = defaultdict(Semaphore)
-    copyLock: defaultdict[str, Semaphore] = defaultdict(Semaphore)
+    # Survives restarts, entries are validated against the store on read
+    packagePathCache = cache.ResolutionCache(CSI_CACHE_DB)
+    # Concurrent publishes of the same thing share builds and closures
+    inflight = locks.SingleFlight()
+    # Held while taking or dropping references to a staged tree
+    stagedLock = locks.KeyedLock()
+    # Shared work runs at the best priority of everyone waiting on it
+    lanes = stages.Lanes()
+    dbSnapshots = nixdb.SnapshotCache(CSI_DB_SNAPSHOTS)
 
     async def NodePublishVolume(self, stream):
         request: csi_pb2.NodePublishVolumeRequest | None = await stream.recv_message()
         if request is None:
             raise ValueError("NodePublishVolumeRequest is None")
-
-        # TODO: Only do this on startup-ish
-        system = (await run_captured("nix", "eval", "--raw", "--impure", "--expr", "builtins.currentSystem")).stdout
+        start_time = time.perf_counter()
 
         targetPath = Path(request.target_path)
-        expression = request.volume_context.get("expression")
-        storePath = request.volume_context.get(system)
-        packagePath: Path = Path("/nonexistent/path/that/should/never/exist")
-        gcPath = CSI_GCROOTS / request.volume_id
+        # Root directory for volume. Contains "workdir" and "upperdir" if
+        # we're doing overlayfs and a link to the staged tree we're using
+        volumeRoot = CSI_VOLUMES / request.volume_id
+        packagePath: Optional[Path] = None
 
+        if request.staging_target_path and await mounts.is_mounted(
+            Path(request.staging_target_path)
+        ):
+            # NodeStageVolume already prepared the tree
+            try:
+                await self.mountVolume(
+                    Path(request.staging_target_path),
+                    targetPath,
+                    request.readonly,
+                    volumeRoot,
+                    stages.FAST,
+                )
+            except BaseException:
+                await REAPER.discard(volumeRoot)
+                raise
+        else:
+            # Inline ephemeral volumes are never staged by kubelet, share
+            # staged trees between them ourselves
+            gcPath = CSI_GCROOTS / request.volume_id
+            packagePath, priority = await self.resolvePackage(
+                request.volume_context, gcPath
+            )
+            tree: Optional[Path] = None
+            try:
+                tree = await self.acquireStaged(
+                    packagePath, request.volume_id, volumeRoot / "staged", priority
+                )
+                await self.mountVolume(
+                    tree / "nix", targetPath, request.readonly, volumeRoot, priority
+                )
+            except BaseException:
+                # Remove gcroots and references if we failed something else
+                await aiofs.unlink(gcPath)
+                if tree is not None:
+                    await self.releaseStaged(tree, request.volume_id)
+                await REAPER.discard(volumeRoot)
+                raise
 
-        if storePath is not None:
-            packagePathCacheResult = self.packagePathCache.get(storePath)
-            if packagePathCacheResult is not None and packagePathCacheResult.exists():
-                packagePath = packagePathCacheResult
-            else:
-                logger.debug(f"{storePath=}")
-                buildCommand = [
-                    "nix",
-                    "build",
-                    "--print-out-paths",
-                    "--out-link",
-                    gcPath,
-                    storePath,
-                ]
+        reply = csi_pb2.NodePublishVolumeResponse()
+        await stream.send_message(reply)
+        metrics.PUBLISH_SECONDS.observe(time.perf_counter() - start_time)
 
-                # Fetch storePath from caches
-                build = await run_console(*buildCommand)
-                if build.returncode != 0:
-                    buildCommand += [
-                        "--substituters",
-                        "https://cache.nixos.org",
-                    ]
-                    build = await run_console(*buildCommand)
-                    if build.returncode != 0:
-                        logger.error(
-                            f"nix build (expression) failed: {build.returncode=}"
-                        )
-                        # Use GRPCError here, we don't need to log output again
-                        raise GRPCError(
-                            Status.INVALID_ARGUMENT,
-                            f"nix build (expression) failed: {build.returncode=} {build.stderr=}",
-                        )
-                packagePath = Path(build.stdout.splitlines()[0])
-                self.packagePathCache[storePath] = packagePath
+        if packagePath is not None and os.getenv("BUILD_CACHE") == "true":
+            uploader.UPLOADER.submit(packagePath)
+
+    async def resolvePackage(
+        self,
+        volumeContext: Mapping[str, str],
+        gcPath: Path,
+        priority: int = stages.NORMAL,
+    ) -> Tuple[Path, int]:
+        """
+        Resolve and realise the store path a volume wants. Returns the path
+        and the priority lane the rest of the publish should use.
+        """
+        nodeFacts = await facts.NODE_FACTS.get()
+
+        expression = volumeContext.get("expression")
+        # Prefer the native system, fall back to extra-platforms
+        storePath = next(
+            (
+                volumeContext[system]
+                for system in nodeFacts.systems
+                if system in volumeContext
+            ),
+            None,
+        )
+
+        # resolve: volume attributes to the store path we'll mount
+        if storePath is not None:
+            packagePath = await aiofs.run(
+                self.packagePathCache.get, f"storePath:{storePath}"
+            ) or Path(storePath)
+            realise = lambda lane: self.realiseStorePath(storePath, gcPath, lane)
         elif expression is not None:
-            async with self.expressionLock[expression]:
-                with tempfile.NamedTemporaryFile(mode="w", suffix=".nix") as f:
-                    expressionFile = Path(f.name)
-                    f.write(expression)
-                    f.flush()
-
-                    packagePathCacheResult = self.packagePathCache.get(expression)
-                    if (
-                        packagePathCacheResult is not None
-                        and packagePathCacheResult.exists()
-                    ):
-                        packagePath = packagePathCacheResult
-                        logger.debug("Package path from cache")
-                    else:
-                        # eval expression to get storePath
-                        eval = await run_captured(
-                            "nix",
-                            "eval",
-                            "--raw",
-                            "--impure",
-                            "--expr",
-                            f"import {expressionFile} {{}}",
-                        )
-                        if eval.returncode != 0:
-                            raise GRPCError(
-                                Status.INVALID_ARGUMENT,
-                                f"nix eval (expression) failed: {eval.returncode=} {eval.combined=}",
-                            )
-                        packagePath = Path(eval.stdout)
-                        self.packagePathCache[expression] = packagePath
-                        logger.debug("Package path after eval, already exists")
-
-                    # Spawn a Job to build the expression
-                    if not packagePath.exists():
-                        jobResult = await runbuild.run(str(packagePath), expression)
-                        if jobResult[0]:
-                            buildResult = await run_captured("nix", "build", storePath)
-                            if buildResult.returncode == 0:
-                                packagePath = Path(buildResult.stdout.splitlines()[0])
-                                self.packagePathCache[expression] = packagePath
-                                logger.debug("Package path from job and build")
-
-                    # Build within CSI if Job build failed, this will be removed
-                    if not packagePath.exists():
-                        buildCommand = [
-                            "nix",
-                            "build",
-                            "--impure",
-                            "--print-out-paths",
-                            "--out-link",
-                            gcPath,
-                            "--expr",
-                            f"import {expressionFile} {{}}",
-                        ]
-
-                        # Build expression
-                        build = await run_console(*buildCommand)
-                        if build.returncode != 0:
-                            buildCommand += [
-                                "--substituters",
-                                "https://cache.nixos.org",
-                            ]
-                            # Retry build with only CNS if it fails
-                            build = await run_console(*buildCommand)
-                            if build.returncode != 0:
-                                logger.error(
-                                    f"nix build (expression) failed: {build.returncode=}"
-                                )
-                                # Use GRPCError here, we don't need to log output again
-                                raise GRPCError(
-                                    Status.INVALID_ARGUMENT,
-                                    f"nix build (expression) failed: {build.returncode=} {build.stderr=}",
-                                )
-
-                        packagePath = Path(build.stdout.splitlines()[0])
-                        self.packagePathCache[expression] = packagePath
-                        logger.debug("Package path from local build")
+            # Same text, different nixpkgs pin or system, different result
+            expressionKey = "expression:" + cache.expression_key(
+                expression, os.environ.get("NIX_PATH", ""), nodeFacts.system
+            )
+            key = ("resolve", expressionKey)
+            with self.lanes(key, priority) as lane:
+                packagePath = await self.inflight.do(
+                    key,
+                    lambda: self.resolveExpression(expression, expressionKey, lane),
+                )
+            realise = lambda lane: self.realiseExpression(
+                expression, expressionKey, packagePath, gcPath, lane
+            )
         else:
             raise GRPCError(
                 Status.INVALID_ARGUMENT,
                 "Set either `expression` or `storePath` in volume attributes",
             )
 
-        # Root directory for volume. Contains /nix, also contains "workdir" and
-        # "upperdir" if we're doing overlayfs
-        volumeRoot = CSI_VOLUMES / request.volume_id
+        # realise: build or substitute, skipped when already in the store.
+        # Publishes that don't need to build take the fast lane through
+        # the remaining stages, prefetches stay in theirs.
+        if await daemon.is_valid_path(packagePath):
+            if priority == stages.NORMAL:
+                priority = stages.FAST
+        else:
+            key = ("realise", str(packagePath))
+            with self.lanes(key, priority) as lane:
+                packagePath = await self.inflight.do(key, lambda: realise(lane))
+        # Coalesced and cached realisations don't create our gcroot
+        await daemon.add_perm_root(packagePath, gcPath)
+        return packagePath, priority
+
+    async def acquireStaged(
+        self, packagePath: Path, holder: str, holderLink: Path, priority: int
+    ) -> Path:
+        """
+        Reference the staged tree for packagePath, preparing it first if
+        nobody has. holderLink is pointed at the tree so the holder can
+        find it again when releasing.
+        """
+        tree = CSI_STAGED / packagePath.name
+        # Whoever is preparing the tree does so at our priority too
+        with self.lanes(("staged", tree.name), priority) as lane:
+            async with self.stagedLock(tree.name):
+                if not await aiofs.exists(tree / "ready"):
+                    await self.prepareStaged(tree, packagePath, lane)
+                await aiofs.mkdir(tree / "refs")
+                await aiofs.touch(tree / "refs" / holder)
+                await aiofs.mkdir(holderLink.parent)
+                await aiofs.symlink(holderLink, tree)
+        return tree
+
+    async def releaseStaged(self, tree: Path, holder: str):
+        """Drop a reference to a staged tree, removing it when unreferenced"""
+        async with self.stagedLock(tree.name):
+            await aiofs.unlink(tree / "refs" / holder)
+            if not await aiofs.is_empty(tree / "refs"):
+                return
+            logger.debug(f"Removing unreferenced staged tree {tree}")
+            await REAPER.discard(tree)
+
+    async def prepareStaged(
+        self, tree: Path, packagePath: Path, priority: stages.Priority
+    ):
+        """Populate tree/nix with the closure and database of packagePath"""
+        # Leftovers from an attempt that didn't finish
+        await REAPER.discard(tree)
         # Capitalized to emphasise they're Nix environment variables
-        NIX_STATE_DIR = volumeRoot / "nix/var/nix"
+        NIX_STATE_DIR = tree / "nix/var/nix"
         # Create NIX_STATE_DIR where database will be initialized
-        NIX_STATE_DIR.mkdir(parents=True, exist_ok=True)
-
-        # Get closure
-        paths = []
-        pathInfoCacheResult = self.pathInfoCache.get(packagePath)
-        if pathInfoCacheResult is not None:
-            paths = pathInfoCacheResult
-            logger.debug("Package closure from cache")
-        else:
-            pathInfo = await run_captured(
-                "nix",
-                "path-info",
-                "--recursive",
-                packagePath,
-            )
-            if pathInfo.returncode != 0:
-                raise NixCsiError(
-                    Status.INTERNAL,
-                    f"nix path-info failed: {pathInfo.returncode=} {pathInfo.stderr=}",
-                )
-            paths = pathInfo.stdout.splitlines()
-            self.pathInfoCache[packagePath] = paths
-            logger.debug("Package closure path-info")
+        await aiofs.mkdir(NIX_STATE_DIR)
 
         try:
-            # Copy closure to substore, rsync saves a lot of implementation
-            # headache here. --archive keeps all attributes, --hard-links
-            # hardlinks everything hardlinkable.
-            async with RSYNC_CONCURRENCY:
-                rsync = await run_captured(
-                    "rsync",
-                    "--one-file-system",
-                    "--recursive",
-                    "--links",
-                    "--hard-links",
-                    "--mkpath",
-                    # "--archive",
-                    *paths,
-                    volumeRoot / "nix/store",
+            # closure: from the in-memory index of the hosts Nix database
+            async with stages.PIPELINE.closure(priority):
+                paths = await self.inflight.do(
+                    ("closure", str(packagePath)),
+                    lambda: self.queryClosure(packagePath),
                 )
-                if rsync.returncode != 0:
-                    raise NixCsiError(
-                        Status.INTERNAL,
-                        f"rsync failed {rsync.returncode=} {rsync.stderr=}",
-                    )
 
-            # Link root derivation to /nix/var/result in the container. This is a "well-know" path
-            lnResult = await run_captured(
-                "ln",
-                "--force",
-                "--symbolic",
-                packagePath,
-                volumeRoot / "nix/var/result",
-            )
-            if lnResult.returncode != 0:
-                raise NixCsiError(
-                    Status.INTERNAL,
-                    f"ln1 failed {lnResult.returncode=} {lnResult.stdout=} {lnResult.stderr=}",
-                )
+            # materialize: hardlink closure into the tree from cached store
+            # path templates, every store path is only walked once per node.
+            try:
+                async with stages.PIPELINE.materialize(priority):
+                    linked = await materialize.materialize(
+                        paths, tree / "nix/store"
+                    )
+                logger.debug(f"Materialized {linked} of {len(paths)} store paths")
+            except OSError as ex:
+                raise NixCsiError(Status.INTERNAL, f"materialize failed: {ex}")
 
-            # gcroots in container
-            (NIX_STATE_DIR / "gcroots").mkdir(parents=True, exist_ok=True)
-            lnRoots = await run_captured(
-                "ln",
-                "--force",
-                "--symbolic",
-                "/nix/var/result",
-                NIX_STATE_DIR / "gcroots" / "result",
-            )
-            if lnRoots.returncode != 0:
-                raise NixCsiError(
-                    Status.INTERNAL,
-                    f"ln2 failed {lnRoots.returncode=} {lnRoots.stdout=} {lnRoots.stderr=}",
+            try:
+                # Link root derivation to /nix/var/result in the container. This is a "well-know" path
+                await aiofs.symlink(tree / "nix/var/result", packagePath)
+                # gcroots in container
+                await aiofs.mkdir(NIX_STATE_DIR / "gcroots")
+                await aiofs.symlink(
+                    NIX_STATE_DIR / "gcroots" / "result", Path("/nix/var/result")
                 )
+            except OSError as ex:
+                raise NixCsiError(Status.INTERNAL, f"result links failed: {ex}")
 
-            # Create Nix database
-            # This is an execline script that runs nix-store --dump-db | NIX_STATE_DIR=something nix-store --load-db
-            nix_init_db = await run_captured(
-                "nix_init_db",
-                NIX_STATE_DIR,
-                *paths,
-            )
-            if nix_init_db.returncode != 0:
-                raise NixCsiError(
-                    Status.INTERNAL,
-                    f"nix_init_db failed {nix_init_db.returncode=} {nix_init_db.stdout=} {nix_init_db.stderr=}",
-                )
+            # db: copy registrations from the hosts database into a copy of
+            # an empty template database, or from a snapshot if we've
+            # created the database for this root before
+            try:
+                async with stages.PIPELINE.db(priority):
+                    await nixdb.init_db(
+                        NIX_STATE_DIR,
+                        paths,
+                        CSI_DB_TEMPLATE,
+                        self.dbSnapshots,
+                        str(packagePath),
+                    )
+            except (nixdb.NixDbError, sqlite3.Error, OSError) as ex:
+                raise NixCsiError(Status.INTERNAL, f"init db failed: {ex}")
         except NixCsiError as ex:
-            # Remove gcroots if we failed something else
-            gcPath.unlink(missing_ok=True)
             # Remove what we were working on
-            shutil.rmtree(volumeRoot, True)
+            await REAPER.discard(tree)
             raise ex
 
-        targetPath.mkdir(parents=True, exist_ok=True)
-        mountCommand = []
-        if request.readonly:
-            # For readonly we use a bind mount, the benefit is that different
-            # container stores using bindmounts will get the same inodes and
-            # share page cache with others, reducing host storage and memory usage.
-            mountCommand = [
-                "mount",
-                "--verbose",
-                "--bind",
-                "-o",
-                "ro",
-                volumeRoot / "nix",
-                targetPath,
-            ]
-        else:
-            # For readwrite we use an overlayfs mount, the benefit here is that
-            # it works as CoW even if the underlying filesystem doesn't support
-            # it, reducing host storage usage.
-            workdir = volumeRoot / "workdir"
-            upperdir = volumeRoot / "upperdir"
-            workdir.mkdir(parents=True, exist_ok=True)
-            upperdir.mkdir(parents=True, exist_ok=True)
-            mountCommand = [
-                "mount",
-                "--verbose",
-                "-t",
-                "overlay",
-                "overlay",
-                "-o",
-                f"rw,lowerdir={volumeRoot / 'nix'},upperdir={upperdir},workdir={workdir}",
-                targetPath,
-            ]
-
-        mount = await run_console(*mountCommand)
-        if mount.returncode == MOUNT_ALREADY_MOUNTED:
-            logger.debug(f"Mount target {targetPath} was already mounted")
-        elif mount.returncode != 0:
-            raise NixCsiError(
-                Status.INTERNAL,
-                f"Failed to mount {mount.returncode=} {mount.stderr=}",
-            )
+        await aiofs.touch(tree / "ready")
 
-        reply = csi_pb2.NodePublishVolumeResponse()
-        await stream.send_message(reply)
+    async def queryClosure(self, packagePath: Path) -> List[str]:
+        """From the closure index, or the daemon if the index can't tell"""
+        try:
+            return await closure.CLOSURES.query([packagePath])
+        except (closure.ClosureError, sqlite3.Error) as ex:
+            logger.debug(f"Closure index failed, asking nix-daemon: {ex}")
+        try:
+            return await daemon.DAEMON.query_closure([packagePath])
+        except (daemon.DaemonError, daemon.DaemonUnavailable) as ex:
+            raise NixCsiError(Status.INTERNAL, f"closure failed: {ex}")
 
-        async def copyToCache(packagePath: str):
-            # Only run one copy per path per time
-            async with self.copyLock[packagePath]:
-                paths = []
-                pathInfoDrv = await run_captured(
+    async def mountVolume(
+        self,
+        lowerdir: Path,
+        targetPath: Path,
+        readonly: bool,
+        volumeRoot: Optional[Path],
+        priority: int,
+    ):
+        """Mount lowerdir at targetPath, readwrite needs volumeRoot for overlayfs"""
+        try:
+            await aiofs.mkdir(targetPath)
+            if readonly:
+                # For readonly we use a bind mount, the benefit is that different
+                # container stores using bindmounts will get the same inodes and
+                # share page cache with others, reducing host storage and memory usage.
+                async with stages.PIPELINE.mount(priority):
+                    await mounts.mount_bind_readonly(lowerdir, targetPath)
+            else:
+                # For readwrite we use an overlayfs mount, the benefit here is that
+                # it works as CoW even if the underlying filesystem doesn't support
+                # it, reducing host storage usage.
+                assert volumeRoot is not None
+                workdir = volumeRoot / "workdir"
+                upperdir = volumeRoot / "upperdir"
+                await aiofs.mkdir(workdir)
+                await aiofs.mkdir(upperdir)
+                async with stages.PIPELINE.mount(priority):
+                    await mounts.mount_overlay(lowerdir, upperdir, workdir, targetPath)
+        except OSError as ex:
+            raise NixCsiError(Status.INTERNAL, f"Failed to mount {targetPath}: {ex}")
+
+    async def fetchStorePath(self, storePath: Path, gcPath: Path) -> Optional[Path]:
+        """
+        Substitute storePath and root it at gcPath, through the daemon if
+        we can and nix build if we can't. None if neither worked.
+        """
+        # nix build builds the outputs of derivations, buildPaths wouldn't
+        if not storePath.name.endswith(".drv"):
+            try:
+                await daemon.DAEMON.build_paths([storePath])
+                await daemon.add_perm_root(storePath, gcPath)
+                return storePath
+            except (daemon.DaemonError, daemon.DaemonUnavailable) as ex:
+                logger.debug(f"nix-daemon couldn't fetch {storePath}: {ex}")
+        fetch = await run_console(
+            "nix",
+            "build",
+            "--print-out-paths",
+            "--out-link",
+            gcPath,
+            storePath,
+        )
+        if fetch.returncode != 0:
+            return None
+        return Path(fetch.stdout.splitlines()[0])
+
+    async def realiseStorePath(
+        self, storePath: str, gcPath: Path, priority: stages.Priority = stages.NORMAL
+    ) -> Path:
+        """Fetch storePath from caches"""
+        logger.debug(f"{storePath=}")
+        async with stages.PIPELINE.realise(priority):
+            packagePath = await self.fetchStorePath(Path(storePath), gcPath)
+            if packagePath is None:
+                # Retry with only CNS
+                build = await run_console(
                     "nix",
-                    "path-info",
-                    "--recursive",
-                    "--derivation",
-                    packagePath,
+                    "build",
+                    "--print-out-paths",
+                    "--out-link",
+                    gcPath,
+                    storePath,
+                    "--substituters",
+                    "https://cache.nixos.org",
                 )
-                if pathInfoDrv.returncode == 0:
-                    paths += pathInfoDrv.stdout.splitlines()
+                if build.returncode != 0:
+                    logger.error(f"nix build (expression) failed: {build.returncode=}")
+                    # Use GRPCError here, we don't need to log output again
+                    raise GRPCError(
+                        Status.INVALID_ARGUMENT,
+                        f"nix build (expression) failed: {build.returncode=} {build.stderr=}",
+                    )
+                packagePath = Path(build.stdout.splitlines()[0])
+        await aiofs.run(self.packagePathCache.put, f"storePath:{storePath}", packagePath)
+        return packagePath
 
-                pathInfo = await run_captured(
-                    "nix",
-                    "path-info",
-                    "--recursive",
-                    packagePath,
+    async def resolveExpression(
+        self,
+        expression: str,
+        expressionKey: str,
+        priority: stages.Priority = stages.NORMAL,
+    ) -> Path:
+        """Evaluate expression to the store path it builds"""
+        packagePathCacheResult = await aiofs.run(
+            self.packagePathCache.get, expressionKey, EXPRESSION_TTL
+        )
+        if packagePathCacheResult is not None:
+            logger.debug("Package path from cache")
+            return packagePathCacheResult
+
+        # eval expression to get storePath
+        async with stages.PIPELINE.resolve(priority):
+            packagePath = await self.evaluate(expression)
+        await aiofs.run(self.packagePathCache.put, expressionKey, packagePath)
+        logger.debug("Package path after eval")
+        return packagePath
+
+    async def evaluate(self, expression: str) -> Path:
+        """In a warm evaluator if we have them, a fresh nix eval if not"""
+        if evaluator.POOL.size > 0:
+            try:
+                return await evaluator.POOL.evaluate(expression)
+            except evaluator.EvalError as ex:
+                raise GRPCError(
+                    Status.INVALID_ARGUMENT,
+                    f"nix eval (expression) failed: {ex}",
                 )
-                if pathInfo.returncode == 0:
-                    paths += pathInfo.stdout.splitlines()
+            except evaluator.WorkerError as ex:
+                logger.warning(f"Evaluator failed, falling back to nix eval: {ex}")
 
-                if pathInfoDrv.returncode != 0 and pathInfo.returncode != 0:
-                    logger.error(
-                        "Unable to copy because path-info failed, shouldn't be possible"
-                    )
-                    return
-
-                # Unique the paths since we're running path-info twice
-                paths = list(set(paths))
-                # Filter derivation files
-                paths = {p for p in paths if not p.endswith(".drv")}
-                # Filter paths that are in self.copyPathsCache
-                paths = {p for p in paths if p not in self.copyPathsCache}
-                if len(paths) > 0:
-                    for _ in range(6):
-                        nixCopy = await run_captured(
-                            "nix", "copy", "--to", "ssh://nix-cache", *paths
-                        )
-                        if nixCopy.returncode == 0:
-                            logger.info(
-                                f"{len(paths)} paths copied to cache in {nixCopy.elapsed:.2f} seconds"
-                            )
-                            for path in paths:
-                                self.copyPathsCache[path] = None
-                            break
-                        else:
-                            logger.error(
-                                f"nix copy failed: {nixCopy.returncode=}\n{nixCopy.combined=}"
-                            )
-                        await asyncio.sleep(10)
-
-        if os.getenv("BUILD_CACHE") == "true":
-            asyncio.create_task(copyToCache(packagePath))
+        async with aiofs.temp_file(expression, ".nix") as expressionFile:
+            eval = await run_captured(
+                "nix",
+                "eval",
+                "--raw",
+                "--impure",
+                "--expr",
+                f"import {expressionFile} {{}}",
+            )
+        if eval.returncode != 0:
+            raise GRPCError(
+                Status.INVALID_ARGUMENT,
+                f"nix eval (expression) failed: {eval.returncode=} {eval.combined=}",
+            )
+        return Path(eval.stdout)
+
+    async def realiseExpression(
+        self,
+        expression: str,
+        expressionKey: str,
+        packagePath: Path,
+        gcPath: Path,
+        priority: stages.Priority = stages.NORMAL,
+    ) -> Path:
+        """Build an evaluated expression, in a Job if we can"""
+        nodeFacts = await facts.NODE_FACTS.get()
+        async with stages.PIPELINE.realise(priority):
+            # Substitute directly if a cache already has it, a Job costs
+            # scheduling and image pulls before it even starts building
+            substituter = await substitute.NARINFO.find(
+                packagePath, nodeFacts.substituters
+            )
+            if substituter is not None:
+                logger.debug(f"{packagePath} is available from {substituter}")
+                fetched = await self.fetchStorePath(packagePath, gcPath)
+                if fetched is not None:
+                    await aiofs.run(self.packagePathCache.put, expressionKey, fetched)
+                    logger.debug("Package path from substituter")
+                    return fetched
+
+        # Spawn a Job to build the expression. Waiting on it has its own
+        # stage, the build runs elsewhere and shouldn't hold a realise slot
+        async with stages.PIPELINE.job(priority):
+            jobResult = await runbuild.run(str(packagePath), expression)
+        # The Job may have pushed it to a cache
+        substitute.NARINFO.forget(packagePath)
+
+        async with stages.PIPELINE.realise(priority):
+            if jobResult[0]:
+                fetched = await self.fetchStorePath(packagePath, gcPath)
+                if fetched is not None:
+                    await aiofs.run(self.packagePathCache.put, expressionKey, fetched)
+                    logger.debug("Package path from job and build")
+                    return fetched
+
+            # Build within CSI if Job build failed, this will be removed
+            async with aiofs.temp_file(expression, ".nix") as expressionFile:
+                buildCommand = [
+                    "nix",
+                    "build",
+                    "--impure",
+                    "--print-out-paths",
+                    "--out-link",
+                    gcPath,
+                    "--expr",
+                    f"import {expressionFile} {{}}",
+                ]
+
+                # Build expression
+                build = await run_console(*buildCommand)
+                if build.returncode != 0:
+                    buildCommand += [
+                        "--substituters",
+                        "https://cache.nixos.org",
+                    ]
+                    # Retry build with only CNS if it fails
+                    build = await run_console(*buildCommand)
+        if build.returncode != 0:
+            logger.error(f"nix build (expression) failed: {build.returncode=}")
+            # Use GRPCError here, we don't need to log output again
+            raise GRPCError(
+                Status.INVALID_ARGUMENT,
+                f"nix build (expression) failed: {build.returncode=} {build.stderr=}",
+            )
+
+        packagePath = Path(build.stdout.splitlines()[0])
+        await aiofs.run(self.packagePathCache.put, expressionKey, packagePath)
+        logger.debug("Package path from local build")
+        return packagePath
+
+    async def prefetch(self, key: str, volumeContext: Mapping[str, str]):
+        """Resolve, realise and stage a volume before it's published"""
+        gcPath = CSI_GCROOTS / f"{key}.prefetch"
+        try:
+            packagePath, _ = await self.resolvePackage(
+                volumeContext, gcPath, stages.LOW
+            )
+            await self.acquireStaged(
+                packagePath, f"{key}.prefetch", CSI_PREFETCH / key, stages.LOW
+            )
+        except BaseException:
+            await self.releasePrefetched(key)
+            raise
+        logger.debug(f"Prefetched {packagePath} for {key}")
+
+    async def releasePrefetched(self, key: str):
+        await aiofs.unlink(CSI_GCROOTS / f"{key}.prefetch")
+        prefetch_link = CSI_PREFETCH / key
+        if await aiofs.is_symlink(prefetch_link):
+            await self.releaseStaged(
+                await aiofs.readlink(prefetch_link), f"{key}.prefetch"
+            )
+            await aiofs.unlink(prefetch_link)
 
     async def NodeUnpublishVolume(self, stream):
         request: csi_pb2.NodeUnpublishVolumeRequest | None = await stream.recv_message()
@@ -520,24 +611,32 @@ class NodeServicer(csi_grpc.NodeBase):
         errors = []
         targetPath = Path(request.target_path)
 
-        # Check if mounted first
-        check = await run_captured("mountpoint", "--quiet", targetPath)
-        if check.returncode == 0:
-            umount = await run_console("umount", "--verbose", targetPath)
-            if umount.returncode != 0:
-                errors.append(f"umount failed {umount.returncode=} {umount.stderr=}")
+        try:
+            await mounts.umount(targetPath)
+        except OSError as ex:
+            errors.append(f"umount failed: {ex}")
 
         gcroot_path = CSI_GCROOTS / request.volume_id
-        if gcroot_path.exists():
+        if await aiofs.is_symlink(gcroot_path):
             try:
-                gcroot_path.unlink()
+                await aiofs.unlink(gcroot_path)
             except Exception as ex:
                 errors.append(f"gcroot unlink failed: {ex}")
 
         volume_path = CSI_VOLUMES / request.volume_id
-        if volume_path.exists():
+        staged_link = volume_path / "staged"
+        if not errors and await aiofs.is_symlink(staged_link):
+            try:
+                await self.releaseStaged(
+                    await aiofs.readlink(staged_link), request.volume_id
+                )
+            except Exception as ex:
+                errors.append(f"staged release failed: {ex}")
+
+        if not errors:
             try:
-                shutil.rmtree(volume_path)
+                # Hand the tree to the reaper rather than deleting it here
+                await REAPER.discard(volume_path)
             except Exception as ex:
                 errors.append(f"volume cleanup failed: {ex}")
 
@@ -552,7 +651,15 @@ class NodeServicer(csi_grpc.NodeBase):
         if request is None:
             raise ValueError("NodeGetCapabilitiesRequest is None")
         # log_request("NodeGetCapabilities", request)
-        reply = csi_pb2.NodeGetCapabilitiesResponse(capabilities=[])
+        reply = csi_pb2.NodeGetCapabilitiesResponse(
+            capabilities=[
+                csi_pb2.NodeServiceCapability(
+                    rpc=csi_pb2.NodeServiceCapability.RPC(
+                        type=csi_pb2.NodeServiceCapability.RPC.STAGE_UNSTAGE_VOLUME
+                    )
+                ),
+            ]
+        )
         await stream.send_message(reply)
 
     async def NodeGetInfo(self, stream):
@@ -574,12 +681,61 @@ class NodeServicer(csi_grpc.NodeBase):
         raise NixCsiError(Status.UNIMPLEMENTED, "NodeExpandVolume not implemented")
 
     async def NodeStageVolume(self, stream):
-        del stream  # typechecker
-        raise NixCsiError(Status.UNIMPLEMENTED, "NodeStageVolume not implemented")
+        request: csi_pb2.NodeStageVolumeRequest | None = await stream.recv_message()
+        if request is None:
+            raise ValueError("NodeStageVolumeRequest is None")
+
+        stagingPath = Path(request.staging_target_path)
+        if not await mounts.is_mounted(stagingPath):
+            # Publishes of this volume have a gcroot of their own
+            gcPath = CSI_GCROOTS / f"{request.volume_id}.stage"
+            packagePath, priority = await self.resolvePackage(
+                request.volume_context, gcPath
+            )
+            holder = f"{request.volume_id}.stage"
+            stageLink = CSI_STAGES / request.volume_id
+            tree: Optional[Path] = None
+            try:
+                tree = await self.acquireStaged(
+                    packagePath, holder, stageLink, priority
+                )
+                # Publishes bind or overlay on top of this readonly mount
+                await self.mountVolume(tree / "nix", stagingPath, True, None, priority)
+            except BaseException:
+                await aiofs.unlink(gcPath)
+                if tree is not None:
+                    await self.releaseStaged(tree, holder)
+                    await aiofs.unlink(stageLink)
+                raise
+
+            if os.getenv("BUILD_CACHE") == "true":
+                uploader.UPLOADER.submit(packagePath)
+
+        reply = csi_pb2.NodeStageVolumeResponse()
+        await stream.send_message(reply)
 
     async def NodeUnstageVolume(self, stream):
-        del stream  # typechecker
-        raise NixCsiError(Status.UNIMPLEMENTED, "NodeUnstageVolume not implemented")
+        request: csi_pb2.NodeUnstageVolumeRequest | None = await stream.recv_message()
+        if request is None:
+            raise ValueError("NodeUnstageVolumeRequest is None")
+
+        stagingPath = Path(request.staging_target_path)
+        try:
+            await mounts.umount(stagingPath)
+        except OSError as ex:
+            raise NixCsiError(Status.INTERNAL, f"umount failed: {ex}")
+
+        await aiofs.unlink(CSI_GCROOTS / f"{request.volume_id}.stage")
+
+        stage_link = CSI_STAGES / request.volume_id
+        if await aiofs.is_symlink(stage_link):
+            await self.releaseStaged(
+                await aiofs.readlink(stage_link), f"{request.volume_id}.stage"
+            )
+            await aiofs.unlink(stage_link)
+
+        reply = csi_pb2.NodeUnstageVolumeResponse()
+        await stream.send_message(reply)
 
 
 class IdentityServicer(csi_grpc.IdentityBase):
@@ -617,14 +773,43 @@ class IdentityServicer(csi_grpc.IdentityBase):
         await stream.send_message(reply)
 
 
-async def serve():
+async def serve(metricsPort: int = 0, prefetchPods: bool = False):
+    if metricsPort:
+        metrics.start(metricsPort)
+    # Delete trashed trees in the background, starting with leftovers
+    await REAPER.start()
     # Clean old volumes on startup
-    reboot_cleanup()
+    await reboot_cleanup()
     # Create directories we operate in
     CSI_ROOT.mkdir(parents=True, exist_ok=True)
     CSI_VOLUMES.mkdir(parents=True, exist_ok=True)
+    CSI_STAGED.mkdir(parents=True, exist_ok=True)
+    CSI_STAGES.mkdir(parents=True, exist_ok=True)
+    CSI_PREFETCH.mkdir(parents=True, exist_ok=True)
     CSI_GCROOTS.mkdir(parents=True, exist_ok=True)
+    # Empty database with the hosts schema, copied into every volume
+    nixdb.create_template(CSI_DB_TEMPLATE)
+    NodeServicer.dbSnapshots.load()
+    # Index the hosts reference graph before we need closures
+    await asyncio.to_thread(closure.CLOSURES.reload)
     await set_nix_path()
+    # Resolve system and extra-platforms before we accept any requests
+    await facts.NODE_FACTS.refresh()
+    if os.getenv("BUILD_CACHE") == "true":
+        uploader.UPLOADER.start()
+    # Build Jobs are tracked through one shared watch
+    runbuild.WATCHER.start()
+    # Let build Jobs know what our store has
+    scheduler.SUMMARY.start()
+
+    nodeServicer = NodeServicer()
+    # Holds from before a restart have nobody left to release them
+    for link in await aiofs.run(lambda: list(CSI_PREFETCH.iterdir())):
+        await nodeServicer.releasePrefetched(link.name)
+    if prefetchPods:
+        prefetch.PREFETCHER.start(
+            nodeServicer.prefetch, nodeServicer.releasePrefetched
+        )
 
     sock_path = "/csi/csi.sock"
     Path(sock_path).unlink(missing_ok=True)
@@ -632,7 +817,7 @@ async def serve():
     server = Server(
         [
             IdentityServicer(),
-            NodeServicer(),
+            nodeServicer,
         ]
     )
 
@@ -643,4 +828,13 @@ async def serve():
 
     await server.start(sock=sock)
     logger.info(f"CSI driver (grpclib) listening on unix://{sock_path}")
+    # Stop taking requests on SIGTERM and let background work finish
+    loop = asyncio.get_running_loop()
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(sig, server.close)
     await server.wait_closed()
+    logger.info("Shutting down")
+    prefetch.PREFETCHER.stop()
+    await uploader.UPLOADER.drain()
+    daemon.DAEMON.close()
+    evaluator.POOL.close()
@@ -0,0 +1,183 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Hashable, Iterator, List, Tuple, Union
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+# Priority lanes, lower goes first. Publishes whose package is already in
+# the store shouldn't queue behind someone else's cold build, and nobody
+# should queue behind a prefetch.
+FAST = 0
+NORMAL = 1
+LOW = 2
+
+# How many publishes may be in each stage at once unless configured
+DEFAULT_LIMITS = {
+    "resolve": 4,  # nix eval
+    "realise": 4,  # nix build, substitution
+    "job": 16,  # waiting on runbuild Jobs, the work happens elsewhere
+    "closure": 16,  # closure lookups
+    "materialize": 4,  # hardlinking the closure into the volume
+    "db": 8,  # volume Nix database
+    "mount": 16,  # mount(8)
+}
+
+
+class Lane:
+    """
+    A priority shared by work that several callers wait on. It's raised
+    to the highest priority among them, including while the work is
+    already queued for a stage, so work a prefetch started doesn't hold
+    up a publish that comes to need it.
+    """
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.users = 0
+        # Where the work is queued right now
+        self.waiting: List[Tuple["PrioritySemaphore", list]] = []
+
+    def raise_to(self, priority: int):
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        for semaphore, waiter in self.waiting:
+            waiter[0] = priority
+            heapq.heapify(semaphore.waiters)
+
+
+Priority = Union[int, Lane]
+
+
+def level(priority: Priority) -> int:
+    return priority.priority if isinstance(priority, Lane) else priority
+
+
+class Lanes:
+    """
+    One Lane per key of shared work, raised by everyone who waits on it.
+    Entries only live while someone waits so the table doesn't grow with
+    every key ever seen.
+    """
+
+    def __init__(self):
+        self.lanes: Dict[Hashable, Lane] = {}
+
+    def __len__(self):
+        return len(self.lanes)
+
+    @contextmanager
+    def __call__(self, key: Hashable, priority: Priority) -> Iterator[Lane]:
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = Lane(level(priority))
+        else:
+            lane.raise_to(level(priority))
+        lane.users += 1
+        try:
+            yield lane
+        finally:
+            lane.users -= 1
+            if lane.users == 0:
+                del self.lanes[key]
+
+
+class PrioritySemaphore:
+    """Semaphore that hands free slots to the highest priority waiter first"""
+
+    def __init__(self, value: int):
+        self.value = value
+        # [priority, counter, future], lists so a Lane can raise them
+        self.waiters: List[list] = []
+        self.counter = itertools.count()
+
+    def locked(self) -> bool:
+        return self.value == 0
+
+    async def acquire(self, priority: Priority = NORMAL):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        # counter keeps it first come first served within a priority
+        waiter = [level(priority), next(self.counter), future]
+        heapq.heappush(self.waiters, waiter)
+        if isinstance(priority, Lane):
+            priority.waiting.append((self, waiter))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed a slot as we got cancelled, pass it on
+                self.release()
+            raise
+        finally:
+            if isinstance(priority, Lane):
+                priority.waiting.remove((self, waiter))
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+
+class Stage:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.semaphore = PrioritySemaphore(limit)
+
+    def configure(self, limit: int):
+        # Only before we start serving, otherwise held slots go missing
+        self.limit = limit
+        self.semaphore = PrioritySemaphore(limit)
+
+    @asynccontextmanager
+    async def __call__(self, priority: Priority = NORMAL) -> AsyncIterator[None]:
+        start_time = time.perf_counter()
+        await self.semaphore.acquire(priority)
+        acquired = time.perf_counter()
+        metrics.STAGE_WAIT_SECONDS.labels(self.name, level(priority)).observe(
+            acquired - start_time
+        )
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+            metrics.STAGE_SECONDS.labels(self.name).observe(
+                time.perf_counter() - acquired
+            )
+
+
+class Pipeline:
+    """The stages of NodePublishVolume, each with its own concurrency limit"""
+
+    def __init__(self, limits: Dict[str, int] = DEFAULT_LIMITS):
+        self.resolve = Stage("resolve", limits["resolve"])
+        self.realise = Stage("realise", limits["realise"])
+        self.job = Stage("job", limits["job"])
+        self.closure = Stage("closure", limits["closure"])
+        self.materialize = Stage("materialize", limits["materialize"])
+        self.db = Stage("db", limits["db"])
+        self.mount = Stage("mount", limits["mount"])
+
+    def configure(self, limits: Dict[str, int]):
+        for name, limit in limits.items():
+            stage: Stage = getattr(self, name)
+            stage.configure(limit)
+        logger.info(
+            "Stage limits: "
+            + ", ".join(f"{name}={getattr(self, name).limit}" for name in DEFAULT_LIMITS)
+        )
+
+
+PIPELINE = Pipeline()
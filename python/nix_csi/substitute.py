@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+
+from pathlib import Path
+from typing import Iterable, Optional
+from cachetools import TTLCache
+
+import httpx
+
+from . import metrics
+
+logger = logging.getLogger("nix-csi")
+
+
+def narinfo_url(substituter: str, storePath: Path) -> str:
+    hashPart = os.path.basename(storePath).split("-", 1)[0]
+    return f"{substituter.rstrip('/')}/{hashPart}.narinfo"
+
+
+class NarinfoChecker:
+    """
+    Asks binary caches whether they have a store path, all of them at once.
+    Misses are remembered for a while so a path that has to be built
+    doesn't cost a round of requests on every publish.
+    """
+
+    def __init__(self, timeout: float = 5, missTTL: float = 300):
+        self.timeout = timeout
+        self.misses: TTLCache[str, None] = TTLCache(10000, missTTL)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def connect(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout)
+        return self.client
+
+    async def has(self, url: str) -> bool:
+        try:
+            response = await self.connect().head(url)
+        except httpx.HTTPError as ex:
+            logger.debug(f"narinfo check {url} failed: {ex}")
+            return False
+        return response.status_code == 200
+
+    async def find(
+        self, storePath: Path, substituters: Iterable[str]
+    ) -> Optional[str]:
+        """The first substituter that has storePath, None if none do"""
+        known = str(storePath) in self.misses
+        metrics.cache_lookup("narinfo-miss", known)
+        if known:
+            return None
+        # Only binary caches we can talk HTTP to, the rest are left to Nix
+        substituters = [
+            s for s in substituters if s.startswith(("http://", "https://"))
+        ]
+        checks = {
+            asyncio.create_task(self.has(narinfo_url(s, storePath))): s
+            for s in substituters
+        }
+        pending = set(checks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for check in done:
+                    if check.result():
+                        return checks[check]
+        finally:
+            for check in pending:
+                check.cancel()
+        self.misses[str(storePath)] = None
+        return None
+
+    def forget(self, storePath: Path):
+        """Drop a remembered miss, e.g. after we've built the path"""
+        self.misses.pop(str(storePath), None)
+
+
+NARINFO = NarinfoChecker()
@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+from . import closure, metrics
+from .commands import run_captured
+
+logger = logging.getLogger("nix-csi")
+
+CACHE_STORE = "ssh://nix-cache"
+# One ssh connection shared by every nix process talking to the cache. Nix
+# doesn't start a master of its own for ssh:// stores with the default
+# max-connections of 1 so this is the one it uses.
+SSH_CONTROL_OPTS = [
+    "-o ControlMaster=auto",
+    "-o ControlPath=/tmp/nix-csi-ssh-%C",
+    "-o ControlPersist=10m",
+]
+
+
+def parse_path_info(text: str) -> Set[str]:
+    """Valid paths from nix path-info --json, across the formats in the wild"""
+    info = json.loads(text or "[]")
+    if isinstance(info, dict):
+        # Nix 2.19+: {"/nix/store/...": {...} | null}
+        return {path for path, value in info.items() if value is not None}
+    # Lix and older Nix: [{"path": "/nix/store/...", "valid": false}, ...]
+    return {
+        entry["path"]
+        for entry in info
+        if "path" in entry and entry.get("valid", True)
+    }
+
+
+def merge_digests(array: bytes, digests: Iterable[bytes], size: int) -> bytes:
+    """
+    Merge digests into a sorted array of them. The array is copied in
+    runs between insertion points, so there are no per entry objects and
+    the cost is linear in its size.
+    """
+    view = memoryview(array)
+    count = len(array) // size
+    merged = bytearray()
+    # Entries of array copied so far
+    start = 0
+    for digest in sorted(digests):
+        lo, hi = start, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if array[mid * size : (mid + 1) * size] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        merged += view[start * size : lo * size]
+        start = lo
+        if array[lo * size : (lo + 1) * size] != digest:
+            merged += digest
+    merged += view[start * size :]
+    return bytes(merged)
+
+
+class DigestSet:
+    """
+    Fixed size set of store paths, kept as 16 byte digests. New digests
+    collect in a small set that's merged into a sorted byte array on a
+    worker thread, lookups in the array are a binary search. Two
+    generations are kept, the older is dropped when the current fills up
+    or gets older than maxAge so the set forgets paths the cache may have
+    collected since.
+    """
+
+    SIZE = 16
+    # Digests collected before they're merged into the array
+    MERGE_AT = 1024
+
+    def __init__(self, maxEntries: int = 1_000_000, maxAge: float = 3600):
+        self.generationEntries = maxEntries // 2
+        self.maxAge = maxAge
+        self.recent: Set[bytes] = set()
+        # Digests a merge is working on, still visible to lookups
+        self.merging: Set[bytes] = set()
+        self.current = b""
+        self.old = b""
+        self.rotated = time.monotonic()
+
+    def digest(self, path: str) -> bytes:
+        return hashlib.blake2b(path.encode(), digest_size=self.SIZE).digest()
+
+    def search(self, array: bytes, digest: bytes) -> bool:
+        lo, hi = 0, len(array) // self.SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = array[mid * self.SIZE : (mid + 1) * self.SIZE]
+            if entry < digest:
+                lo = mid + 1
+            elif entry > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __contains__(self, path: str) -> bool:
+        self.expire()
+        digest = self.digest(path)
+        return (
+            digest in self.recent
+            or digest in self.merging
+            or self.search(self.current, digest)
+            or self.search(self.old, digest)
+        )
+
+    def __len__(self) -> int:
+        return (
+            len(self.recent)
+            + len(self.merging)
+            + (len(self.current) + len(self.old)) // self.SIZE
+        )
+
+    def add(self, path: str):
+        self.recent.add(self.digest(path))
+
+    async def update(self, paths: Iterable[str]):
+        """Add paths, merging into the array once enough have collected"""
+        for path in paths:
+            self.add(path)
+        if len(self.recent) >= self.MERGE_AT and not self.merging:
+            await self.merge()
+
+    async def merge(self):
+        base = self.current
+        self.merging, self.recent = self.recent, set()
+        try:
+            merged = await asyncio.to_thread(
+                merge_digests, base, self.merging, self.SIZE
+            )
+        except BaseException:
+            self.recent |= self.merging
+            raise
+        finally:
+            batch, self.merging = self.merging, set()
+        if self.current is not base:
+            # Rotated while we were merging, try again next time
+            self.recent |= batch
+            return
+        self.current = merged
+        if len(self.current) // self.SIZE >= self.generationEntries:
+            self.rotate()
+
+    def rotate(self):
+        # Unmerged digests are the newest, they stay where they are
+        self.old, self.current = self.current, b""
+        self.rotated = time.monotonic()
+
+    def expire(self):
+        if time.monotonic() - self.rotated > self.maxAge:
+            self.rotate()
+
+
+class Uploader:
+    """
+    Copies closures of published store paths to the cluster cache. Roots
+    submitted within a flush window are merged into one batch, the batch is
+    checked against the cache with a single path-info call and only missing
+    paths are copied. Failed batches are retried with exponential backoff.
+
+    Memory stays bounded while the cache is unreachable: at most maxInFlight
+    batches are uploading or backing off, roots submitted meanwhile wait in
+    a queue of maxPending and the rest are dropped. Publishing never waits
+    for the cache.
+    """
+
+    def __init__(
+        self,
+        store: str = CACHE_STORE,
+        flushWindow: float = 5.0,
+        maxAttempts: int = 6,
+        backoffBase: float = 2.0,
+        backoffCap: float = 300.0,
+        maxPending: int = 1024,
+        maxInFlight: int = 2,
+    ):
+        self.store = store
+        self.flushWindow = flushWindow
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.maxPending = maxPending
+        # Insertion ordered set of roots waiting for a batch
+        self.pending: Dict[str, None] = {}
+        self.dropped = 0
+        self.slots = asyncio.Semaphore(maxInFlight)
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.task: Optional[asyncio.Task] = None
+        self.uploads: Set[asyncio.Task] = set()
+        # Paths we know the cache has, so we don't ask again
+        self.uploaded = DigestSet()
+
+    def start(self):
+        opts = os.environ.get("NIX_SSHOPTS", "").split()
+        if not any("ControlMaster" in opt for opt in opts):
+            os.environ["NIX_SSHOPTS"] = " ".join(opts + SSH_CONTROL_OPTS)
+        self.task = asyncio.create_task(self.run())
+
+    def submit(self, packagePath: Path):
+        """Upload the closure of packagePath with the next batch"""
+        if self.task is None or self.closing:
+            return
+        if str(packagePath) not in self.pending:
+            if len(self.pending) >= self.maxPending:
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    logger.warning(
+                        f"Upload queue full, dropped {self.dropped} roots so far"
+                    )
+                return
+            self.pending[str(packagePath)] = None
+            metrics.UPLOAD_QUEUE.set(len(self.pending))
+        self.wakeup.set()
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter, keeps nodes from retrying in lockstep after an outage
+        return random.uniform(0, min(self.backoffCap, self.backoffBase**attempt))
+
+    async def run(self):
+        while not self.closing:
+            await self.wakeup.wait()
+            if not self.closing:
+                # Let publishes arriving around the same time join the batch
+                await asyncio.sleep(self.flushWindow)
+            # Roots keep queueing up while every slot is busy
+            await self.slots.acquire()
+            self.wakeup.clear()
+            roots, self.pending = list(self.pending), {}
+            metrics.UPLOAD_QUEUE.set(0)
+            if not roots:
+                self.slots.release()
+                continue
+            logger.debug(
+                f"Upload batch of {len(roots)} roots, {len(self.uploads)} batches in flight"
+            )
+            task = asyncio.create_task(self.upload(roots))
+            self.uploads.add(task)
+            metrics.UPLOAD_INFLIGHT.set(len(self.uploads))
+            task.add_done_callback(self.finished)
+
+    def finished(self, task: asyncio.Task):
+        self.uploads.discard(task)
+        metrics.UPLOAD_INFLIGHT.set(len(self.uploads))
+        self.slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Upload batch failed: {task.exception()}")
+
+    async def drain(self, timeout: float = 30):
+        """Flush what's queued and wait for uploads, cancel what's left after timeout"""
+        if self.task is None:
+            return
+        self.closing = True
+        self.wakeup.set()
+        try:
+            await asyncio.wait_for(self.task, timeout)
+            if self.uploads:
+                await asyncio.wait(self.uploads, timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        for task in [self.task, *self.uploads]:
+            task.cancel()
+        if self.pending or self.uploads:
+            logger.warning(
+                f"Shutting down with {len(self.pending)} roots and {len(self.uploads)} batches not uploaded"
+            )
+
+    async def closure(self, roots: Iterable[str]) -> List[str]:
+        paths = set()
+        for root in roots:
+            for derivation in [True, False]:
+                try:
+                    paths.update(
+                        await closure.CLOSURES.query([root], derivation=derivation)
+                    )
+                except (closure.ClosureError, sqlite3.Error) as ex:
+                    logger.debug(f"{root} {derivation=} closure failed: {ex}")
+        # Derivations aren't substitutable, don't bother uploading them
+        return sorted(
+            p for p in paths if not p.endswith(".drv") and p not in self.uploaded
+        )
+
+    async def missing(self, paths: List[str]) -> List[str]:
+        """The subset of paths the cache doesn't have"""
+        # Parsed as a whole, a truncated document is useless
+        pathInfo = await run_captured(
+            "nix",
+            "path-info",
+            "--json",
+            "--store",
+            self.store,
+            *paths,
+            stdoutLimit=None,
+        )
+        try:
+            valid = parse_path_info(pathInfo.stdout)
+        except (ValueError, TypeError, AttributeError) as ex:
+            logger.debug(
+                f"nix path-info failed, copying everything: {pathInfo.returncode=} {ex}"
+            )
+            return paths
+        await self.uploaded.update(valid)
+        return [p for p in paths if p not in valid]
+
+    async def upload(self, roots: List[str]):
+        paths = await self.closure(roots)
+        if len(paths) == 0:
+            return
+        paths = await self.missing(paths)
+        if len(paths) == 0:
+            logger.debug("Cache already has every path in the batch")
+            return
+
+        for attempt in range(self.maxAttempts):
+            nixCopy = await run_captured("nix", "copy", "--to", self.store, *paths)
+            if nixCopy.returncode == 0:
+                logger.info(
+                    f"{len(paths)} paths copied to cache in {nixCopy.elapsed:.2f} seconds"
+                    f" ({len(paths) / max(nixCopy.elapsed, 0.001):.1f} paths/s),"
+                    f" {len(self.pending)} roots queued"
+                )
+                await self.uploaded.update(paths)
+                metrics.UPLOADED_PATHS.inc(len(paths))
+                return
+            if self.closing:
+                break
+            delay = self.backoff(attempt + 1)
+            logger.error(
+                f"nix copy failed: {nixCopy.returncode=}, retrying in {delay:.1f} seconds\n{nixCopy.combined=}"
+            )
+            await asyncio.sleep(delay)
+        logger.error(f"Giving up copying {len(paths)} paths to cache")
+
+
+UPLOADER = Uploader()
@@ -0,0 +1,49 @@
+import sqlite3
+
+from nix_csi import cache
+
+
+def test_expression_key_context():
+    key = cache.expression_key("import <nixpkgs> {}", "nixpkgs=/nix/store/a", "x86_64-linux")
+    assert key == cache.expression_key("import <nixpkgs> {}", "nixpkgs=/nix/store/a", "x86_64-linux")
+    assert key != cache.expression_key("import <nixpkgs> {}", "nixpkgs=/nix/store/b", "x86_64-linux")
+    assert key != cache.expression_key("import <nixpkgs> {}", "nixpkgs=/nix/store/a", "aarch64-linux")
+    assert cache.expression_key("x", "ab", "c") != cache.expression_key("x", "a", "bc")
+
+
+def test_resolution_max_age(tmp_path):
+    resolutions = cache.ResolutionCache(tmp_path / "cache.sqlite")
+    resolutions.put("key", tmp_path)
+    assert resolutions.get("key", 60) == tmp_path
+    assert resolutions.get("key", 0) is None
+    # Expired entries are dropped
+    assert resolutions.get("key") is None
+
+
+def test_resolution_missing_path(tmp_path):
+    resolutions = cache.ResolutionCache(tmp_path / "cache.sqlite")
+    resolutions.put("key", tmp_path / "gone")
+    assert resolutions.get("key") is None
+
+
+def test_resolution_old_schema(tmp_path):
+    db = sqlite3.connect(tmp_path / "cache.sqlite")
+    db.execute(
+        "CREATE TABLE Resolutions (key TEXT PRIMARY KEY NOT NULL,"
+        " storePath TEXT NOT NULL, atime INTEGER NOT NULL)"
+    )
+    db.execute("INSERT INTO Resolutions VALUES ('key', ?, 1)", (str(tmp_path),))
+    db.commit()
+    db.close()
+    resolutions = cache.ResolutionCache(tmp_path / "cache.sqlite")
+    # No creation time, so expired for anyone asking for a maximum age
+    assert resolutions.get("key", 60) is None
+
+
+def test_normalize_expression():
+    assert cache.normalize_expression("\r\n  \nfoo\r\nbar\r\n\n \n") == "foo\nbar"
+    # Trailing whitespace can be part of an indented string
+    a = "''\n  a  \n''"
+    b = "''\n  a\n''"
+    assert cache.normalize_expression(a) != cache.normalize_expression(b)
+    assert cache.expression_key(a) != cache.expression_key(b)
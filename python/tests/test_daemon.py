@@ -0,0 +1,122 @@
+import asyncio
+
+from pathlib import Path
+
+import pytest
+
+from bench import daemon as fake, store
+from nix_csi import daemon
+
+
+@pytest.fixture
+def nixStore(tmp_path):
+    roots = store.build_store(tmp_path, paths=8, files=1, fanout=2, roots=1)
+    return tmp_path, roots[0]
+
+
+def serve(nixStore, version=fake.VERSION) -> fake.FakeDaemon:
+    root, _ = nixStore
+    server = fake.FakeDaemon(
+        root / "daemon.sock", root / "var/nix/db/db.sqlite", version=version
+    )
+    server.start()
+    return server
+
+
+@pytest.mark.parametrize("minor", [21, 32, 33, 35])
+def test_handshake(nixStore, minor):
+    root, package = nixStore
+    server = serve(nixStore, (1 << 8) | minor)
+
+    async def main():
+        conn = await daemon.Connection.open(root / "daemon.sock")
+        try:
+            assert daemon.minor(conn.version) == minor
+            # Anything left over from the handshake would be read as a reply
+            assert await conn.is_valid_path(package)
+            assert not await conn.is_valid_path(f"{root}/store/missing")
+        finally:
+            conn.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize("minor", [21, 35])
+def test_error(nixStore, minor):
+    root, package = nixStore
+    server = serve(nixStore, (1 << 8) | minor)
+
+    async def main():
+        pool = daemon.DaemonPool(root / "daemon.sock", size=1)
+        missing = Path(f"{root}/store/missing")
+        with pytest.raises(daemon.DaemonError, match="is not valid"):
+            await pool.build_paths([missing])
+        # The daemon finished the operation, the connection is reused
+        assert await pool.is_valid_path(Path(package))
+        assert await pool.query_path_info(missing) is None
+        pool.close()
+
+    try:
+        asyncio.run(main())
+        assert server.connections == 1
+    finally:
+        server.stop()
+
+
+def test_query_closure(nixStore):
+    root, package = nixStore
+    server = serve(nixStore)
+
+    async def main():
+        pool = daemon.DaemonPool(root / "daemon.sock")
+        try:
+            info = await pool.query_path_info(Path(package))
+            assert info is not None and info.path == package and info.references
+            paths = await pool.query_closure([Path(package)])
+            assert package in paths and set(info.references) <= set(paths)
+            with pytest.raises(daemon.DaemonError):
+                await pool.query_closure([Path(f"{root}/store/missing")])
+        finally:
+            pool.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop()
+
+
+def test_recycling(nixStore):
+    root, package = nixStore
+    server = serve(nixStore)
+
+    async def main():
+        pool = daemon.DaemonPool(root / "daemon.sock", size=1, maxUses=3)
+        try:
+            for _ in range(6):
+                assert await pool.is_valid_path(Path(package))
+            assert server.connections == 2
+            # The daemon reports operations it doesn't know and hangs up
+            with pytest.raises(daemon.DaemonError):
+                await pool.run(daemon.OP_IS_VALID_PATH, lambda conn: conn.call(999))
+            await asyncio.sleep(0.1)
+            assert await pool.is_valid_path(Path(package))
+            assert server.connections == 4
+        finally:
+            pool.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop()
+
+
+def test_unavailable(tmp_path):
+    async def main():
+        pool = daemon.DaemonPool(tmp_path / "nothing.sock")
+        with pytest.raises(daemon.DaemonUnavailable):
+            await pool.is_valid_path(tmp_path)
+
+    asyncio.run(main())
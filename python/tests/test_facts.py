@@ -0,0 +1,45 @@
+import asyncio
+
+from nix_csi import facts
+
+
+def test_conf_stamp(tmp_path):
+    assert facts.conf_stamp(tmp_path / "missing") == ()
+    (tmp_path / "nix.conf").write_text("")
+    stamp = facts.conf_stamp(tmp_path)
+    assert stamp == facts.conf_stamp(tmp_path)
+    (tmp_path / "nix.conf").write_text("extra-platforms = i686-linux\n")
+    assert stamp != facts.conf_stamp(tmp_path)
+
+
+def test_checked_at_most_every_interval(tmp_path, monkeypatch):
+    resolved = []
+    stamps = []
+    stamp = facts.conf_stamp
+
+    async def resolve():
+        resolved.append(None)
+        return facts.NodeFacts("x86_64-linux", [], [])
+
+    def counting_stamp(confDir):
+        stamps.append(confDir)
+        return stamp(confDir)
+
+    monkeypatch.setattr(facts, "resolve", resolve)
+    monkeypatch.setattr(facts, "conf_stamp", counting_stamp)
+
+    async def main():
+        cache = facts.NodeFactsCache(tmp_path, checkInterval=3600)
+        await asyncio.gather(*[cache.get() for _ in range(100)])
+        assert len(resolved) == 1 and len(stamps) == 1
+        # Changes are only noticed once the interval has passed
+        (tmp_path / "nix.conf").write_text("")
+        await cache.get()
+        assert len(resolved) == 1
+        cache.checkInterval = 0
+        await cache.get()
+        assert len(resolved) == 2
+        await cache.get()
+        assert len(resolved) == 2 and len(stamps) == 4
+
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import asyncio
+import os
+
+from nix_csi import materialize
+
+
+def make_path(root, name):
+    path = root / name
+    (path / "bin").mkdir(parents=True)
+    (path / "bin" / name).write_text(name)
+    os.symlink(name, path / "bin" / f"{name}-link")
+    return str(path)
+
+
+def test_weight(tmp_path):
+    template = materialize.scan_tree(make_path(tmp_path, "hello"))
+    assert len(template) == 4
+    assert template.weight() == 2 * 141 + len("bin") + 57 + len("bin/hello") + (
+        162 + len("bin/hello-link") + len("hello")
+    )
+
+
+def test_evicts_by_bytes(tmp_path):
+    paths = [make_path(tmp_path / "store", f"p{i}") for i in range(4)]
+    weight = materialize.scan_tree(paths[0]).weight()
+    templates = materialize.TemplateCache(maxBytes=2 * weight)
+    for path in paths:
+        templates.get(path)
+    assert list(templates.templates) == paths[2:]
+    assert templates.bytes == sum(templates.weights.values()) <= 2 * weight
+
+
+def test_materialize(tmp_path, monkeypatch):
+    paths = [make_path(tmp_path / "store", f"p{i}") for i in range(4)]
+    templates = materialize.TemplateCache()
+    monkeypatch.setattr(materialize, "TEMPLATES", templates)
+    scans = []
+    scan_tree = materialize.scan_tree
+
+    def counting_scan(storePath):
+        scans.append(storePath)
+        return scan_tree(storePath)
+
+    monkeypatch.setattr(materialize, "scan_tree", counting_scan)
+    for volume in ["a", "b"]:
+        storeDir = tmp_path / volume / "nix/store"
+        assert asyncio.run(materialize.materialize(paths, storeDir)) == len(paths)
+        assert (storeDir / "p0/bin/p0").read_text() == "p0"
+        assert os.readlink(storeDir / "p0/bin/p0-link") == "p0"
+    # The second volume is linked from cached templates
+    assert sorted(scans) == paths
+    assert asyncio.run(materialize.materialize(paths, storeDir)) == 0
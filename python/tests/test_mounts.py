@@ -0,0 +1,45 @@
+import errno
+
+import pytest
+
+from nix_csi import mounts
+
+
+def test_unmount_missing_target(tmp_path):
+    assert mounts.unmount(tmp_path / "nope") is False
+
+
+def test_unmount_enoent(monkeypatch, tmp_path):
+    def sys_umount(target, flags=0):
+        raise OSError(errno.ENOENT, "No such file or directory", str(target))
+
+    monkeypatch.setattr(mounts, "sys_umount", sys_umount)
+    assert mounts.unmount(tmp_path / "gone") is False
+
+
+def test_unmount_einval_not_mounted(monkeypatch, tmp_path):
+    def sys_umount(target, flags=0):
+        raise OSError(errno.EINVAL, "Invalid argument", str(target))
+
+    monkeypatch.setattr(mounts, "sys_umount", sys_umount)
+    monkeypatch.setattr(mounts, "mounted", lambda path: False)
+    assert mounts.unmount(tmp_path) is False
+
+
+def test_unmount_einval_still_mounted(monkeypatch, tmp_path):
+    def sys_umount(target, flags=0):
+        raise OSError(errno.EINVAL, "Invalid argument", str(target))
+
+    monkeypatch.setattr(mounts, "sys_umount", sys_umount)
+    monkeypatch.setattr(mounts, "mounted", lambda path: True)
+    with pytest.raises(OSError):
+        mounts.unmount(tmp_path)
+
+
+def test_unmount_other_errors(monkeypatch, tmp_path):
+    def sys_umount(target, flags=0):
+        raise OSError(errno.EBUSY, "Device or resource busy", str(target))
+
+    monkeypatch.setattr(mounts, "sys_umount", sys_umount)
+    with pytest.raises(OSError):
+        mounts.unmount(tmp_path)
@@ -0,0 +1,108 @@
+import shutil
+import sqlite3
+import time
+
+from contextlib import closing
+
+import pytest
+
+from bench import nixdb as bench, store
+from nix_csi import closure, nixdb
+
+
+@pytest.fixture
+def host(tmp_path):
+    roots = store.build_store(tmp_path, paths=20, files=0, fanout=3, roots=1)
+    with closing(sqlite3.connect(tmp_path / "var/nix/db/db.sqlite")) as db, db:
+        # Something for deriver to carry over
+        db.execute(
+            "UPDATE ValidPaths SET deriver = ? WHERE path = ?",
+            (f"{tmp_path}/store/{store.store_hash('drv')}-root-0.drv", roots[0]),
+        )
+    index = closure.ClosureIndex(tmp_path / "var/nix")
+    index.reload()
+    return tmp_path, index.closure([roots[0]])
+
+
+def rows(dbPath):
+    """Registrations by path, so ids don't matter"""
+    with closing(sqlite3.connect(dbPath)) as db:
+        validPaths = {
+            row[0]: row[1:]
+            for row in db.execute(
+                "SELECT path, hash, narSize, deriver, ultimate, sigs, ca FROM ValidPaths"
+            )
+        }
+        times = [t for (t,) in db.execute("SELECT registrationTime FROM ValidPaths")]
+        refs = set(
+            db.execute(
+                "SELECT a.path, b.path FROM Refs r"
+                " JOIN ValidPaths a ON a.id = r.referrer"
+                " JOIN ValidPaths b ON b.id = r.reference"
+            )
+        )
+        outputs = set(
+            db.execute(
+                "SELECT v.path, o.id, o.path FROM DerivationOutputs o"
+                " JOIN ValidPaths v ON v.id = o.drv"
+            )
+        )
+    return validPaths, times, refs, outputs
+
+
+def test_write_db(host):
+    root, paths = host
+    with closing(sqlite3.connect(root / "var/nix/db/db.sqlite")) as db, db:
+        # Pretend a path in the closure is a derivation, load-db would
+        # parse the .drv file for its outputs
+        db.execute(
+            "INSERT INTO DerivationOutputs (drv, id, path)"
+            " SELECT id, 'out', ? FROM ValidPaths WHERE path = ?",
+            (paths[-1], paths[0]),
+        )
+    nixdb.create_template(root / "template", root / "var/nix")
+    start = int(time.time())
+    nixdb.write_db(root / "volume", paths, root / "template", root / "var/nix")
+    validPaths, times, refs, outputs = rows(root / "volume/db/db.sqlite")
+    hostPaths, _, hostRefs, hostOutputs = rows(root / "var/nix/db/db.sqlite")
+
+    assert set(validPaths) == set(paths)
+    for path, (narHash, narSize, deriver, ultimate, sigs, ca) in validPaths.items():
+        assert (narHash, narSize, deriver) == hostPaths[path][:3]
+        # Like load-db, trust and signatures don't carry over
+        assert (ultimate, sigs, ca) == (None, None, None)
+    assert any(row[2] for row in validPaths.values())
+    assert all(start <= t <= time.time() for t in times)
+    assert refs == {(a, b) for a, b in hostRefs if a in validPaths}
+    assert outputs and outputs == {o for o in hostOutputs if o[0] in validPaths}
+    for name in ["gcroots", "profiles", "temproots"]:
+        assert (root / "volume" / name).is_dir()
+
+
+def test_write_db_invalid_path(host):
+    root, paths = host
+    nixdb.create_template(root / "template", root / "var/nix")
+    with pytest.raises(nixdb.NixDbError):
+        nixdb.write_db(
+            root / "volume",
+            [*paths, f"{root}/store/{store.store_hash('missing')}-missing"],
+            root / "template",
+            root / "var/nix",
+        )
+
+
+@pytest.mark.skipif(shutil.which("nix-store") is None, reason="needs nix-store")
+def test_write_db_matches_load_db(host):
+    root, paths = host
+    nixdb.create_template(root / "template", root / "var/nix")
+    nixdb.write_db(root / "volume", paths, root / "template", root / "var/nix")
+    bench.load_db(root / "loaded", paths, root / "store", root / "var/nix")
+    validPaths, times, refs, outputs = rows(root / "volume/db/db.sqlite")
+    loadedPaths, loadedTimes, loadedRefs, loadedOutputs = rows(
+        root / "loaded/db/db.sqlite"
+    )
+    assert validPaths == loadedPaths
+    # Both register at load time rather than copying the hosts time
+    assert abs(min(times) - min(loadedTimes)) < 60
+    assert refs == loadedRefs
+    assert outputs == loadedOutputs
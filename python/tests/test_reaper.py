@@ -0,0 +1,25 @@
+import asyncio
+
+from nix_csi import reaper
+
+
+def test_reaper(tmp_path):
+    trash = tmp_path / "trash"
+    (trash / "leftover/sub").mkdir(parents=True)
+    volume = tmp_path / "volume"
+    (volume / "upperdir").mkdir(parents=True)
+    (volume / "upperdir/file").write_text("")
+
+    async def main():
+        reap = reaper.Reaper(trash)
+        await reap.start()
+        await reap.discard(volume)
+        # Gone right away, deleted in the background
+        assert not volume.exists()
+        await reap.discard(tmp_path / "missing")
+        await reap.join()
+        for task in reap.tasks:
+            task.cancel()
+
+    asyncio.run(main())
+    assert list(trash.iterdir()) == []
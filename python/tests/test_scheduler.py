@@ -0,0 +1,32 @@
+import base64
+
+from nix_csi import scheduler
+
+
+def summary(node, paths):
+    bloom = scheduler.summarize(paths)
+    return {
+        "metadata": {"name": f"nix-csi-summary-{node}"},
+        "data": {"node": node, "bits": str(bloom.bits), "hashes": str(bloom.hashes)},
+        "binaryData": {"bloom": base64.b64encode(bloom.data).decode()},
+    }
+
+
+def test_best_summary():
+    paths = [f"/nix/store/{i:032}-input" for i in range(100)]
+    other = [f"/nix/store/{i:032}-other" for i in range(100, 200)]
+    summaries = [
+        summary("few", paths[:10] + other),
+        summary("most", paths[:90]),
+        {"metadata": {"name": "broken"}, "data": {"node": "broken"}},
+    ]
+    node, score = scheduler.best_summary(summaries, paths)
+    assert node == "most" and 0.9 <= score < 0.95
+
+
+def test_bloom_membership():
+    paths = [f"/nix/store/{i:032}-input" for i in range(1000)]
+    bloom = scheduler.summarize(paths)
+    assert all(path in bloom for path in paths)
+    misses = sum(f"/nix/store/{i:032}-x" in bloom for i in range(1000, 11000))
+    assert misses < 10000 * scheduler.FALSE_POSITIVE_RATE * 2
@@ -0,0 +1,37 @@
+import asyncio
+
+from nix_csi import stages
+
+
+def test_lane_raised_while_queued():
+    async def main():
+        semaphore = stages.PrioritySemaphore(1)
+        await semaphore.acquire()
+        order = []
+
+        async def take(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            semaphore.release()
+
+        lanes = stages.Lanes()
+        with lanes("tree", stages.LOW) as lane:
+            prefetch = asyncio.create_task(take("prefetch", lane))
+            normal = asyncio.create_task(take("normal", stages.NORMAL))
+            await asyncio.sleep(0)
+            # A publish joins the prefetch's work
+            with lanes("tree", stages.FAST) as joined:
+                assert joined is lane and lane.priority == stages.FAST
+            semaphore.release()
+            await asyncio.gather(prefetch, normal)
+        assert order == ["prefetch", "normal"]
+        assert not lane.waiting and len(lanes) == 0
+
+    asyncio.run(main())
+
+
+def test_lane_not_lowered():
+    lanes = stages.Lanes()
+    with lanes("tree", stages.FAST) as lane:
+        with lanes("tree", stages.LOW):
+            assert lane.priority == stages.FAST
@@ -0,0 +1,43 @@
+import asyncio
+import random
+
+from nix_csi import uploader
+
+
+def test_merge_digests():
+    size = 4
+    existing = sorted({random.randbytes(size) for _ in range(1000)})
+    new = {random.randbytes(size) for _ in range(300)} | set(existing[::7])
+    merged = uploader.merge_digests(b"".join(existing), new, size)
+    assert merged == b"".join(sorted(set(existing) | new))
+    assert uploader.merge_digests(b"", new, size) == b"".join(sorted(new))
+
+
+def test_digest_set_update():
+    async def main():
+        paths = [f"/nix/store/{i:032}-path" for i in range(5000)]
+        digests = uploader.DigestSet(maxEntries=100_000)
+        for start in range(0, len(paths), 100):
+            await digests.update(paths[start : start + 100])
+        assert digests.current
+        assert len(digests) == len(paths)
+        assert all(path in digests for path in paths)
+        assert "/nix/store/missing" not in digests
+
+    asyncio.run(main())
+
+
+def test_digest_set_rotate():
+    async def main():
+        digests = uploader.DigestSet(maxEntries=2 * uploader.DigestSet.MERGE_AT)
+        first = [f"/nix/store/{i:032}-first" for i in range(digests.MERGE_AT)]
+        await digests.update(first)
+        # A full generation rotates, the previous one is still searched
+        assert not digests.current and len(digests.old) // digests.SIZE == len(first)
+        assert all(path in digests for path in first)
+        second = [f"/nix/store/{i:032}-second" for i in range(digests.MERGE_AT)]
+        await digests.update(second)
+        assert all(path in digests for path in second)
+        assert not any(path in digests for path in first)
+
+    asyncio.run(main())